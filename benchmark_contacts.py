@@ -0,0 +1,166 @@
+from timeit import default_timer as timer
+import argparse
+import json
+import logging
+import numpy as np  # type: ignore
+
+from gym_racer.envs.racer_car import RacerCar
+from gym_racer.envs.racer_contacts import CarSpatialHash
+from gym_racer.envs.racer_contacts import car_contacts
+
+
+def parse_arguments():
+    """Setup CLI interface"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the car contacts with the spatial hash"
+    )
+
+    parser.add_argument(
+        "-s", "--rand_seed", type=int, default=1, help="random seed to use"
+    )
+    parser.add_argument(
+        "-nc",
+        "--num_cars",
+        type=int,
+        nargs="+",
+        default=[100, 300, 1000, 3000, 10000, 30000],
+        help="Numbers of cars to benchmark.",
+    )
+    parser.add_argument(
+        "-ns", "--num_steps", type=int, default=50, help="steps to time per config"
+    )
+    parser.add_argument(
+        "-ca",
+        "--car_area",
+        type=float,
+        default=20000,
+        help="field area for each car, the density is kept constant",
+    )
+    parser.add_argument(
+        "-bf",
+        "--brute_force_max",
+        type=int,
+        default=3000,
+        help="time also the check of all the pairs, up to this number of cars",
+    )
+    parser.add_argument(
+        "-ds", "--dir_step", type=int, default=3, help="dir_step of the cars"
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, default=None, help="save the results in this json"
+    )
+
+    # last line to parse the args
+    args = parser.parse_args()
+    return args
+
+
+def setup_logger(logLevel="DEBUG"):
+    """Setup logger that outputs to console for the module"""
+    logroot = logging.getLogger("c")
+    logroot.propagate = False
+    logroot.setLevel(logLevel)
+
+    module_console_handler = logging.StreamHandler()
+    log_format_module = "%(message)s"
+    formatter = logging.Formatter(log_format_module)
+    module_console_handler.setFormatter(formatter)
+
+    logroot.addHandler(module_console_handler)
+
+
+def brute_force_contacts(pos_x, pos_y, width, height):
+    """check all the pairs of car rects, the quadratic reference"""
+    left = pos_x - width // 2
+    top = pos_y - height // 2
+    overlap = (
+        (left[:, None] < left[None, :] + width[None, :])
+        & (left[None, :] < left[:, None] + width[:, None])
+        & (top[:, None] < top[None, :] + height[None, :])
+        & (top[None, :] < top[:, None] + height[:, None])
+    )
+    np.fill_diagonal(overlap, False)
+    return overlap.any(axis=1)
+
+
+def benchmark_num_cars(num_cars, rect_wid, rect_hei, args) -> dict:
+    """time the contacts of num_cars moving on a field with constant density"""
+    logg = logging.getLogger(f"c.{__name__}.benchmark_num_cars")
+    logg.setLevel("INFO")
+
+    side = int(np.sqrt(num_cars * args.car_area))
+    pos_x = np.random.randint(0, side, size=num_cars)
+    pos_y = np.random.randint(0, side, size=num_cars)
+    dir_id = np.random.randint(len(rect_wid), size=num_cars)
+
+    cell_size = int(max(rect_wid.max(), rect_hei.max()))
+    spatial_hash = CarSpatialHash(cell_size)
+
+    hash_time = 0.0
+    brute_time = 0.0
+    num_contacts = 0
+    for _ in range(args.num_steps):
+        # the cars move a little each step
+        pos_x += np.random.randint(-5, 6, size=num_cars)
+        pos_y += np.random.randint(-5, 6, size=num_cars)
+        dir_id = (dir_id + np.random.randint(-1, 2, size=num_cars)) % len(rect_wid)
+        width = rect_wid[dir_id]
+        height = rect_hei[dir_id]
+
+        t01 = timer()
+        contacts = car_contacts(spatial_hash, pos_x, pos_y, width, height)
+        hash_time += timer() - t01
+        num_contacts += np.count_nonzero(contacts)
+
+        if num_cars <= args.brute_force_max:
+            t01 = timer()
+            brute_contacts = brute_force_contacts(pos_x, pos_y, width, height)
+            brute_time += timer() - t01
+            if not np.array_equal(contacts, brute_contacts):
+                raise RuntimeError(f"The contacts of {num_cars} cars are wrong")
+
+    result = {
+        "num_cars": num_cars,
+        "hash_time": hash_time / args.num_steps,
+        "hash_time_per_car": hash_time / args.num_steps / num_cars,
+        "contacts_per_step": num_contacts / args.num_steps,
+    }
+    recap = f"cars {num_cars:6d}"
+    recap += f"  hash {result['hash_time']*1e3:8.3f} ms"
+    recap += f"  per car {result['hash_time_per_car']*1e6:6.3f} us"
+    if num_cars <= args.brute_force_max:
+        result["brute_time"] = brute_time / args.num_steps
+        recap += f"  all pairs {result['brute_time']*1e3:9.3f} ms"
+    recap += f"  contacts {result['contacts_per_step']:8.1f}"
+    logg.info(recap)
+
+    return result
+
+
+def run_benchmark(args) -> None:
+    """benchmark the contacts for all the numbers of cars"""
+    logg = logging.getLogger(f"c.{__name__}.run_benchmark")
+    logg.setLevel("INFO")
+
+    np.random.seed(args.rand_seed)
+
+    # the rects of the car in each direction
+    racer_car = RacerCar(dir_step=args.dir_step, render_mode="console")
+    all_dirs = range(0, 360, args.dir_step)
+    rect_wid = np.array([racer_car.rot_car_rect[dire].width for dire in all_dirs])
+    rect_hei = np.array([racer_car.rot_car_rect[dire].height for dire in all_dirs])
+
+    results = []
+    for num_cars in args.num_cars:
+        results.append(benchmark_num_cars(num_cars, rect_wid, rect_hei, args))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+        logg.info(f"Saved results in {args.output}")
+
+
+if __name__ == "__main__":
+    setup_logger()
+    args = parse_arguments()
+    run_benchmark(args)
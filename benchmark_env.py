@@ -0,0 +1,431 @@
+from contextlib import redirect_stdout
+from random import seed
+from timeit import default_timer as timer
+import argparse
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import numpy as np  # type: ignore
+
+# run headless: pygame uses the dummy video driver if there is no display
+if "DISPLAY" not in os.environ and "WAYLAND_DISPLAY" not in os.environ:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+from gym_racer.envs import RacerEnv
+
+
+# the sensor_array_params swept for each sensor type
+SENSOR_PARAMS = {
+    "lidar": {
+        "small": {
+            "ray_num": 3,
+            "ray_step": 15,
+            "ray_sensors_per_ray": 10,
+            "ray_max_angle": 70,
+        },
+        "default": {
+            "ray_num": 7,
+            "ray_step": 15,
+            "ray_sensors_per_ray": 20,
+            "ray_max_angle": 70,
+        },
+        "large": {
+            "ray_num": 15,
+            "ray_step": 10,
+            "ray_sensors_per_ray": 40,
+            "ray_max_angle": 130,
+        },
+    },
+    "diamond": {
+        "small": {"viewfield_size": 10, "viewfield_step": 10},
+        "default": {"viewfield_size": 20, "viewfield_step": 10},
+        "large": {"viewfield_size": 40, "viewfield_step": 5},
+    },
+}
+
+# the metrics compared with the baseline
+COMPARED_METRICS = [
+    "init_time",
+    "reset_time",
+    "step_time",
+    "steps_per_sec",
+    "render_time",
+    "import_gym_racer",
+    "import_envs",
+    "import_racer_env",
+    "construct",
+    "first_reset",
+    "first_step",
+]
+
+# the metrics where a higher value is better, the others are times
+HIGHER_IS_BETTER = ["steps_per_sec"]
+
+# the slowdowns from the baseline below these, in seconds, are noise and not
+# regressions: 5 us for the times of a step, a reset or a frame (also for
+# steps_per_sec, compared as time per step), 1 ms for the startup times
+NOISE_FLOOR = {
+    "init_time": 1e-3,
+    "reset_time": 5e-6,
+    "step_time": 5e-6,
+    "steps_per_sec": 5e-6,
+    "render_time": 5e-6,
+    "import_gym_racer": 1e-3,
+    "import_envs": 1e-3,
+    "import_racer_env": 1e-3,
+    "construct": 1e-3,
+    "first_reset": 1e-3,
+    "first_step": 1e-3,
+}
+
+# run in a new interpreter to time the startup of a worker
+STARTUP_CODE = """
+import json
+from timeit import default_timer as timer
+t0 = timer()
+import gym_racer
+t1 = timer()
+import gym_racer.envs
+t2 = timer()
+from gym_racer.envs import RacerEnv
+t3 = timer()
+racer_env = RacerEnv(render_mode="console")
+t4 = timer()
+racer_env.reset()
+t5 = timer()
+racer_env.step((1, 0))
+t6 = timer()
+times = {
+    "import_gym_racer": t1 - t0,
+    "import_envs": t2 - t1,
+    "import_racer_env": t3 - t2,
+    "construct": t4 - t3,
+    "first_reset": t5 - t4,
+    "first_step": t6 - t5,
+}
+print(json.dumps(times))
+"""
+
+
+def parse_arguments():
+    """Setup CLI interface"""
+    parser = argparse.ArgumentParser(description="Benchmark the racer env")
+
+    parser.add_argument(
+        "-s", "--rand_seed", type=int, default=1, help="random seed to use"
+    )
+    parser.add_argument(
+        "-ns", "--num_steps", type=int, default=2000, help="steps to time per config"
+    )
+    parser.add_argument(
+        "-nr", "--num_resets", type=int, default=100, help="resets to time per config"
+    )
+    parser.add_argument(
+        "-nf",
+        "--num_frames",
+        type=int,
+        default=100,
+        help="frames to render per config",
+    )
+    parser.add_argument(
+        "-rm",
+        "--render_mode",
+        type=str,
+        nargs="+",
+        default=["console", "human"],
+        choices=["human", "console"],
+        help="Render modes to benchmark.",
+    )
+    parser.add_argument(
+        "-sat",
+        "--sensor_array_type",
+        type=str,
+        nargs="+",
+        default=["lidar", "diamond"],
+        choices=["lidar", "diamond"],
+        help="Sensor array types to benchmark.",
+    )
+    parser.add_argument(
+        "-sp",
+        "--sensor_params",
+        type=str,
+        nargs="+",
+        default=["small", "default", "large"],
+        choices=["small", "default", "large"],
+        help="Sizes of the sensor_array_params to benchmark.",
+    )
+    parser.add_argument(
+        "-ds",
+        "--dir_step",
+        type=int,
+        nargs="+",
+        default=[3, 10],
+        help="Values of dir_step to benchmark.",
+    )
+    parser.add_argument(
+        "-st",
+        "--startup_runs",
+        type=int,
+        default=5,
+        help="new interpreters to start to time the imports, 0 to skip",
+    )
+    parser.add_argument(
+        "-so",
+        "--startup_only",
+        action="store_true",
+        help="only time the startup, skip the sweep of the configs",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, default=None, help="save the results in this json"
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        type=str,
+        default=None,
+        help="compare the results with this json, saved by a previous run",
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative slowdown from the baseline flagged as a regression",
+    )
+
+    # last line to parse the args
+    args = parser.parse_args()
+    return args
+
+
+def setup_logger(logLevel="DEBUG"):
+    """Setup logger that outputs to console for the module"""
+    logroot = logging.getLogger("c")
+    logroot.propagate = False
+    logroot.setLevel(logLevel)
+
+    module_console_handler = logging.StreamHandler()
+    log_format_module = "%(message)s"
+    formatter = logging.Formatter(log_format_module)
+    module_console_handler.setFormatter(formatter)
+
+    logroot.addHandler(module_console_handler)
+
+
+def config_name(sensor_array_type, sensor_params, dir_step, render_mode):
+    """the key of a config in the results"""
+    return f"{sensor_array_type}-{sensor_params}-ds{dir_step}-{render_mode}"
+
+
+def benchmark_config(
+    sensor_array_type, sensor_params, dir_step, render_mode, args
+) -> dict:
+    """time init, reset, step and render of one env config"""
+    logg = logging.getLogger(f"c.{__name__}.benchmark_config")
+    logg.setLevel("INFO")
+
+    sensor_array_params = SENSOR_PARAMS[sensor_array_type][sensor_params]
+
+    t01 = timer()
+    racer_env = RacerEnv(
+        sensor_array_type=sensor_array_type,
+        render_mode=render_mode,
+        sensor_array_params=sensor_array_params,
+        dir_step=dir_step,
+    )
+    # the precomputed data is built at the first reset
+    racer_env.reset()
+    init_time = timer() - t01
+
+    # reset latency
+    reset_times = np.empty(args.num_resets)
+    for i in range(args.num_resets):
+        t01 = timer()
+        racer_env.reset()
+        reset_times[i] = timer() - t01
+
+    # step throughput, the resets at the end of the episodes are not timed
+    actions = np.random.randint(0, 3, size=(args.num_steps, 2))
+    racer_env.reset()
+    tot_step_time = 0.0
+    num_episodes = 1
+    for action in actions:
+        t01 = timer()
+        obs, reward, done, info = racer_env.step(action)
+        tot_step_time += timer() - t01
+        if done:
+            racer_env.reset()
+            num_episodes += 1
+
+    # render time, the console mode prints are discarded
+    render_times = np.empty(args.num_frames)
+    racer_env.reset()
+    sink = io.StringIO()
+    for i in range(args.num_frames):
+        obs, reward, done, info = racer_env.step(actions[i % len(actions)])
+        with redirect_stdout(sink):
+            t01 = timer()
+            racer_env.render(mode=render_mode, reward=reward)
+            render_times[i] = timer() - t01
+        sink.seek(0)
+        sink.truncate()
+        if done:
+            racer_env.reset()
+
+    result = {
+        "sensor_array_type": sensor_array_type,
+        "sensor_params": sensor_params,
+        "dir_step": dir_step,
+        "render_mode": render_mode,
+        "init_time": init_time,
+        "reset_time": float(np.mean(reset_times)),
+        "step_time": tot_step_time / args.num_steps,
+        "steps_per_sec": args.num_steps / tot_step_time,
+        "render_time": float(np.mean(render_times)),
+        "num_episodes": num_episodes,
+    }
+
+    recap = f"{config_name(sensor_array_type, sensor_params, dir_step, render_mode)}"
+    recap += f"\tsteps/s {result['steps_per_sec']:10.1f}"
+    recap += f"  reset {result['reset_time']*1e6:8.1f} us"
+    recap += f"  render {result['render_time']*1e3:8.3f} ms"
+    recap += f"  init {result['init_time']:6.3f} s"
+    logg.info(recap)
+
+    return result
+
+
+def benchmark_startup(num_runs) -> dict:
+    """time the imports, the construction, the first reset and step of an env
+
+    each run is done in a new interpreter, the median of the runs is kept
+    """
+    logg = logging.getLogger(f"c.{__name__}.benchmark_startup")
+    logg.setLevel("INFO")
+
+    # the package is imported from the dir of this script
+    env = dict(os.environ)
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    env["PYTHONPATH"] = os.pathsep.join([repo_dir, env.get("PYTHONPATH", "")])
+
+    all_times = []
+    for _ in range(num_runs):
+        cmd = [sys.executable, "-c", STARTUP_CODE]
+        out = subprocess.run(cmd, env=env, capture_output=True, text=True, check=True)
+        all_times.append(json.loads(out.stdout.splitlines()[-1]))
+
+    result = {}
+    for metric in all_times[0]:
+        result[metric] = float(np.median([times[metric] for times in all_times]))
+
+    recap = "startup\t"
+    for metric, value in result.items():
+        recap += f"  {metric} {value*1e3:.1f} ms"
+    logg.info(recap)
+
+    return result
+
+
+def compare_baseline(results, baseline, tolerance) -> list:
+    """find the metrics that got worse than the baseline by more than tolerance
+
+    a metric is a regression only if it is also slower by more than its
+    NOISE_FLOOR, so the tiny times do not fail on the timer noise
+
+    returns a list of (config, metric, baseline value, new value)
+    """
+    logg = logging.getLogger(f"c.{__name__}.compare_baseline")
+    logg.setLevel("INFO")
+
+    base_results = baseline["results"]
+    regressions = []
+    for name, result in results.items():
+        if name not in base_results:
+            logg.info(f"{name} is not in the baseline")
+            continue
+        base = base_results[name]
+        for metric in COMPARED_METRICS:
+            if metric not in result or metric not in base:
+                continue
+            old = base[metric]
+            new = result[metric]
+            if metric in HIGHER_IS_BETTER:
+                worse = new < old * (1 - tolerance)
+                slowdown = 1 / new - 1 / old
+            else:
+                worse = new > old * (1 + tolerance)
+                slowdown = new - old
+            if worse and slowdown > NOISE_FLOOR[metric]:
+                regressions.append((name, metric, old, new))
+
+    for name, metric, old, new in regressions:
+        logg.info(f"REGRESSION {name} {metric}: {old:.6g} -> {new:.6g}")
+    if len(regressions) == 0:
+        logg.info(f"No regression from the baseline (tolerance {tolerance})")
+
+    return regressions
+
+
+def run_benchmark(args) -> int:
+    """benchmark all the configs, returns the number of regressions"""
+    logg = logging.getLogger(f"c.{__name__}.run_benchmark")
+    logg.setLevel("INFO")
+
+    seed(args.rand_seed)
+    np.random.seed(args.rand_seed)
+
+    results = {}
+    if args.startup_runs > 0:
+        results["startup"] = benchmark_startup(args.startup_runs)
+
+    configs = itertools.product(
+        args.sensor_array_type, args.sensor_params, args.dir_step, args.render_mode
+    )
+    if args.startup_only:
+        configs = []
+    for sensor_array_type, sensor_params, dir_step, render_mode in configs:
+        name = config_name(sensor_array_type, sensor_params, dir_step, render_mode)
+        results[name] = benchmark_config(
+            sensor_array_type, sensor_params, dir_step, render_mode, args
+        )
+
+    report = {
+        "machine": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+        },
+        "params": {
+            "rand_seed": args.rand_seed,
+            "num_steps": args.num_steps,
+            "num_resets": args.num_resets,
+            "num_frames": args.num_frames,
+        },
+        "results": results,
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logg.info(f"Saved results in {args.output}")
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_baseline(results, baseline, args.tolerance)
+
+    return len(regressions)
+
+
+if __name__ == "__main__":
+    setup_logger()
+    args = parse_arguments()
+    num_regressions = run_benchmark(args)
+    sys.exit(1 if num_regressions > 0 else 0)
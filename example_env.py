@@ -121,6 +121,7 @@ def test_interactive_env(num_frames, fps, sensor_array_type):
         render_mode="human",
         sensor_array_type=sensor_array_type,
     )
+    racer_env.reset()
 
     # clock for interactive play
     clock = pygame.time.Clock()
@@ -216,6 +217,8 @@ def test_automatic_env(num_frames, render_mode, sensor_array_type) -> None:
     logg.info(f"Action Space {racer_env.action_space}")
     logg.info(f"State Space {racer_env.observation_space}")
 
+    racer_env.reset()
+
     going = True
     i = 0
     tot_frame_times: float = 0
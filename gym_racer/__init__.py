@@ -1,5 +1,27 @@
-from gym.envs.registration import register  # type: ignore
+import sys
 
-# define the name to call the env
-# gym.make("racer-v0")
-register(id="racer-v0", entry_point="gym_racer.envs:RacerEnv")
+# register the envs only once, both gym and the import can ask for it
+_envs_registered = False
+
+
+def register_envs():
+    """register the envs in gym
+
+    gym calls this when it is imported, through the gym.envs entry point
+    declared in setup.py, so that importing gym_racer does not import gym
+    """
+    global _envs_registered
+    if _envs_registered:
+        return
+
+    from gym.envs.registration import register  # type: ignore
+
+    # define the name to call the env
+    # gym.make("racer-v0")
+    register(id="racer-v0", entry_point="gym_racer.envs:RacerEnv")
+    _envs_registered = True
+
+
+# if gym is already imported, its entry points have already been loaded
+if "gym" in sys.modules:
+    register_envs()
@@ -1 +1,26 @@
-from gym_racer.envs.racer_env import RacerEnv
+# the envs are imported only when they are used, so that importing the
+# package does not import gym and numpy
+_LAZY_ENVS = {
+    "RacerEnv": "gym_racer.envs.racer_env",
+    "VectorRacerEnv": "gym_racer.envs.racer_vector_env",
+    "SubprocRacerEnv": "gym_racer.envs.racer_subproc_env",
+    "MultiRacerEnv": "gym_racer.envs.racer_multi_env",
+    "TrajectoryRecorder": "gym_racer.envs.racer_recorder",
+}
+
+__all__ = list(_LAZY_ENVS)
+
+
+def __getattr__(name):
+    if name in _LAZY_ENVS:
+        from importlib import import_module
+
+        env_class = getattr(import_module(_LAZY_ENVS[name]), name)
+        # cache it in the module, so this is called only once
+        globals()[name] = env_class
+        return env_class
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import numpy as np
+
+from gym_racer.envs.utils import get_cache_dir
+
+
+class LidarAtlas:
+    """Precomputed lidar obs for every position of the car on the field
+
+    The obs of a lidar ray only depends on the car position and on the
+    sensor offsets of the ray, and many (direction, ray) pairs share the same
+    offsets, so the atlas stores for each unique ray and each position the
+    index of the first sensor out of the road, with shape
+    (num_unique_rays, field_wid, field_hei).
+
+    The atlas is saved in the cache dir, keyed by the hash of the map and of
+    the rays, and opened as a read only memmap: all the envs on the same
+    machine share it through the page cache.
+    """
+
+    def __init__(self, all_sensor_array, raw_map, cache_dir=None):
+        """
+        all_sensor_array: the dict direction: sensor array of a lidar RacerCar
+        raw_map: the road map of RacerMap
+        """
+        # stack the rays, shape (num_dirs, tot_ray_num, ray_sensors_per_ray, 2)
+        all_dirs = list(all_sensor_array)
+        dir_rays = np.stack([all_sensor_array[dire] for dire in all_dirs])
+        num_dirs, tot_ray_num, ray_sensors_per_ray, _ = dir_rays.shape
+        self.ray_sensors_per_ray = ray_sensors_per_ray
+
+        # find the unique rays, and which one each (direction, ray) uses
+        flat_rays = dir_rays.reshape(num_dirs * tot_ray_num, ray_sensors_per_ray * 2)
+        unique_rays, ray_uid = np.unique(flat_rays, axis=0, return_inverse=True)
+        self.unique_rays = unique_rays.reshape(-1, ray_sensors_per_ray, 2)
+        self.ray_uid = ray_uid.reshape(num_dirs, tot_ray_num)
+
+        self.field_wid, self.field_hei = raw_map.shape
+
+        # the atlas depends only on the map and on the rays
+        hasher = hashlib.sha1()
+        hasher.update(np.ascontiguousarray(raw_map).tobytes())
+        hasher.update(str(raw_map.shape).encode())
+        hasher.update(self.unique_rays.astype(np.int16).tobytes())
+        atlas_name = f"lidar_atlas_{hasher.hexdigest()}.npy"
+        self.atlas_path = os.path.join(get_cache_dir(cache_dir), atlas_name)
+
+        if not os.path.exists(self.atlas_path):
+            self._build_atlas(raw_map)
+
+        self.atlas = np.load(self.atlas_path, mmap_mode="r")
+
+    def lookup(self, pos_x, pos_y, dir_id, out=None):
+        """the lidar obs of a car in that pose, None if out of the field
+
+        if out is given the obs is written there, without allocating
+        """
+        if 0 <= pos_x < self.field_wid and 0 <= pos_y < self.field_hei:
+            pos_atlas = self.atlas[:, pos_x, pos_y]
+            return np.take(pos_atlas, self.ray_uid[dir_id], out=out, mode="clip")
+        return None
+
+    def _build_atlas(self, raw_map):
+        """compute the atlas and save it to atlas_path
+
+        the file is written with a temporary name and then moved in place,
+        so that other processes never open a partial atlas
+        """
+        atlas_shape = (len(self.unique_rays), self.field_wid, self.field_hei)
+        tmp_path = f"{self.atlas_path}.{os.getpid()}.tmp"
+        atlas = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.uint8, shape=atlas_shape
+        )
+
+        for uid, ray in enumerate(self.unique_rays):
+            atlas[uid] = self._first_off_road(ray, raw_map)
+
+        atlas.flush()
+        del atlas
+        os.replace(tmp_path, self.atlas_path)
+
+    def _first_off_road(self, ray, raw_map):
+        """the index of the first sensor out of the road, from every position
+
+        out of the field sensors count as out of the road, like the argmin
+        over the collisions in RacerEnv._analyze_collisions
+        """
+        field_size = self.field_wid * self.field_hei
+        first_off = np.full(field_size, self.ray_sensors_per_ray, dtype=np.uint8)
+        flat_map = raw_map.ravel()
+
+        # the positions whose ray is still on the road
+        alive = np.arange(field_size, dtype=np.int32)
+        base_x, base_y = np.divmod(alive, self.field_hei)
+        for s_id, (s_x, s_y) in enumerate(ray):
+            pos_x = base_x + s_x
+            pos_y = base_y + s_y
+            inside = (pos_x >= 0) & (pos_x < self.field_wid)
+            inside &= (pos_y >= 0) & (pos_y < self.field_hei)
+            flat_pos = pos_x * self.field_hei + pos_y
+            flat_pos[~inside] = 0
+            road = inside & (flat_map[flat_pos] == 1)
+
+            first_off[alive[~road]] = s_id
+            alive = alive[road]
+            base_x = base_x[road]
+            base_y = base_y[road]
+
+        return first_off.reshape(self.field_wid, self.field_hei)
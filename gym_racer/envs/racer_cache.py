@@ -0,0 +1,87 @@
+import hashlib
+import os
+import shutil
+import weakref
+import numpy as np
+
+from gym_racer.envs.utils import get_cache_dir
+
+
+class TableDict(dict):
+    """A dict name: array, that can be weakly referenced
+    """
+
+
+# the tables in use in this process, (kind, key): TableDict; only weak
+# references are kept, an entry is dropped when no object uses its tables
+_TABLE_CACHE = weakref.WeakValueDictionary()
+
+
+def cached_tables(kind, key, builder, disk_cache=False, cache_dir=None):
+    """get the tables identified by (kind, key), building them only once
+
+    kind: the name of the group of tables, used in the file names
+    key: a string with all the parameters the tables depend on
+    builder: a function with no arguments that returns a dict name: array
+
+    returns a TableDict, the caller keeps it as long as it uses the tables
+
+    The tables are shared by all the callers in the process, so they are
+    read only. The cache does not keep them alive: when no caller holds the
+    TableDict anymore they are freed, and built again if needed. If
+    disk_cache is True they are also saved in the cache dir (see
+    get_cache_dir) and opened as read only memory maps, that all the
+    processes share through the page cache.
+    """
+    mem_key = (kind, key)
+    tables = _TABLE_CACHE.get(mem_key)
+    if tables is not None:
+        return tables
+
+    if disk_cache:
+        tables = _load_or_build(kind, key, builder, cache_dir)
+    else:
+        tables = TableDict(builder())
+        for table in tables.values():
+            table.setflags(write=False)
+
+    _TABLE_CACHE[mem_key] = tables
+    return tables
+
+
+def clear_table_cache():
+    """forget the tables loaded in this process, the files are not removed
+    """
+    _TABLE_CACHE.clear()
+
+
+def _load_or_build(kind, key, builder, cache_dir):
+    """load the tables from the cache dir, building and saving them if needed
+
+    each table is saved as a .npy file in a dir named after the hash of the
+    key; the dir is written with a temporary name and then moved in place,
+    so that other processes never open partial tables
+    """
+    key_hash = hashlib.sha1(key.encode()).hexdigest()
+    tables_dir = os.path.join(get_cache_dir(cache_dir), f"{kind}_{key_hash}")
+
+    if not os.path.exists(tables_dir):
+        tmp_dir = f"{tables_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        tables = builder()
+        for name, table in tables.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), table)
+        try:
+            os.replace(tmp_dir, tables_dir)
+        except OSError:
+            # another process saved the same tables in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    tables = TableDict()
+    for file_name in sorted(os.listdir(tables_dir)):
+        name, ext = os.path.splitext(file_name)
+        if ext == ".npy":
+            table_path = os.path.join(tables_dir, file_name)
+            # a plain ndarray view of the memmap, that is faster to index
+            tables[name] = np.asarray(np.load(table_path, mmap_mode="r"))
+    return tables
@@ -4,16 +4,30 @@ from math import cos
 from math import radians
 from math import sin
 
-import pygame
-from pygame import Surface
-from pygame.sprite import Sprite
-from pygame.transform import rotate
+from gym_racer.envs.racer_cache import cached_tables
 
 #  from gym_racer.envs.utils import getMyLogger
+from gym_racer.envs.utils import Rect
 from gym_racer.envs.utils import compute_rot_matrix
+from gym_racer.envs.utils import rotated_size
 
+# the rotated car images, shared by all the cars in the process, by
+# (dir_step, render_mode)
+_ROT_IMAGE_CACHE = {}
+
+
+class RacerCar:
+    """A racing car
+
+    pygame is only needed to draw the car, in 'human' and 'rgb_array'
+    render_mode: the rects
+    used to collide the car with the road are computed without it
+
+    The rotated sensor arrays, rect sizes and images only depend on the
+    sensor params and on dir_step, so they are computed once and shared by
+    all the cars in the process, see cached_tables
+    """
 
-class RacerCar(Sprite):
     def __init__(
         self,
         pos_x=0,
@@ -24,12 +38,15 @@ class RacerCar(Sprite):
         sensor_array_type="lidar",
         render_mode="human",
         sensor_array_params=None,
+        disk_cache=False,
+        cache_dir=None,
     ):
+        """
+        disk_cache: save the precomputed tables in cache_dir, for later processes
+        """
         #  logg = logging.getLogger(f"c.{__name__}.__init__")
         #  logg.info(f"Start init RacerCar")
 
-        super().__init__()
-
         self.pos_x = pos_x
         self.pos_y = pos_y
         self.precise_x = pos_x
@@ -38,6 +55,8 @@ class RacerCar(Sprite):
         self.sensor_array_type = sensor_array_type
         self.render_mode = render_mode
         self.sensor_array_params = sensor_array_params
+        self.disk_cache = disk_cache
+        self.cache_dir = cache_dir
 
         self.direction = direction  # in degrees
         self.dir_step = dir_step
@@ -49,6 +68,7 @@ class RacerCar(Sprite):
 
         # setup the sensor_array_template
         self._create_car_sensors()
+        self.car_pos = np.zeros(2, dtype=np.int64)
 
         # setup pygame objects and attributes: rect is always needed, image
         # only if render_mode is 'human'
@@ -88,7 +108,7 @@ class RacerCar(Sprite):
         # update Sprite rect and image
         self.rect = self.rot_car_rect[self.direction]
         self.rect.center = self.pos_x, self.pos_y
-        if self.render_mode == "human":
+        if self.render_mode in ("human", "rgb_array"):
             # pick the correct image and place it
             self.image = self.rot_car_image[self.direction]
 
@@ -105,7 +125,24 @@ class RacerCar(Sprite):
 
         self.rect = self.rot_car_rect[self.direction]
         self.rect.center = self.pos_x, self.pos_y
-        if self.render_mode == "human":
+        if self.render_mode in ("human", "rgb_array"):
+            # pick the correct image and place it
+            self.image = self.rot_car_image[self.direction]
+
+    def set_state(self, pos_x, pos_y, precise_x, precise_y, direction, speed):
+        """Set the car state, as saved from the attributes of a car
+        """
+        self.pos_x = pos_x
+        self.pos_y = pos_y
+        self.precise_x = precise_x
+        self.precise_y = precise_y
+
+        self.direction = direction
+        self.speed = speed
+
+        self.rect = self.rot_car_rect[self.direction]
+        self.rect.center = self.pos_x, self.pos_y
+        if self.render_mode in ("human", "rgb_array"):
             # pick the correct image and place it
             self.image = self.rot_car_image[self.direction]
 
@@ -139,43 +176,101 @@ class RacerCar(Sprite):
         #  logg = getMyLogger(f"c.{__class__.__name__}._create_car_sensors")
         #  logg.debug(f"Start _create_car_sensors")
 
+        # the arrays only depend on the params and on dir_step
+        sensor_key = self._set_sensor_array_params()
+        key = f"{self.sensor_array_type} {sensor_key} {self.dir_step}"
+        tables = cached_tables(
+            "sensor_array",
+            key,
+            self._build_sensor_tables,
+            self.disk_cache,
+            self.cache_dir,
+        )
+
+        # the rotated arrays are read only views of the shared table, that is
+        # kept alive as long as the car uses it
+        self.sensor_tables = tables
+        self.all_sensor_array = {}
+        stacked_sa = tables["all_sensor_array"]
+        for dir_id, dire in enumerate(range(0, 360, self.dir_step)):
+            self.all_sensor_array[dire] = stacked_sa[dir_id]
+
+    def _build_sensor_tables(self):
+        """rotate the sensor array template for all possible directions
+
+        returns the arrays stacked in the table all_sensor_array
+        """
         # get the template
         sensor_array_template = self._create_sensor_array_template()
 
         # rotate it
-        self.all_sensor_array = {}
+        all_sensor_array = []
         for dire in range(0, 360, self.dir_step):
             rot_mat = compute_rot_matrix(360 - dire)
             rotated_sa = np.matmul(rot_mat, sensor_array_template)
             int_sa = np.array(rotated_sa, dtype=np.int16)
-            self.all_sensor_array[dire] = int_sa.transpose()
 
-        # reshape it
-        for dire in range(0, 360, self.dir_step):
+            # reshape it
             if self.sensor_array_type == "diamond":
-                self.all_sensor_array[dire] = self.all_sensor_array[dire].reshape(
-                    self.viewfield_size, self.viewfield_size, 2
-                )
-
+                sa_shape = self.viewfield_size, self.viewfield_size, 2
             elif self.sensor_array_type == "lidar":
-                self.all_sensor_array[dire] = self.all_sensor_array[dire].reshape(
-                    self.tot_ray_num, self.ray_sensors_per_ray, 2
-                )
-
+                sa_shape = self.tot_ray_num, self.ray_sensors_per_ray, 2
             else:
                 raise ValueError(f"Unknown sensor_array_type {self.sensor_array_type}")
+            all_sensor_array.append(int_sa.transpose().reshape(sa_shape))
+
+        return {"all_sensor_array": np.stack(all_sensor_array)}
+
+    def _set_sensor_array_params(self):
+        """set the params of the sensor array, from sensor_array_params
+
+        returns a string with the values of the params
+        """
+        if self.sensor_array_type == "diamond":
+            if self.sensor_array_params is None:
+                self.viewfield_size = 20  # number of rows/columns in the sensor
+                self.viewfield_step = 10  # spacing between the dots
+            else:
+                self.viewfield_size = self.sensor_array_params["viewfield_size"]
+                self.viewfield_step = self.sensor_array_params["viewfield_step"]
+            return f"{self.viewfield_size} {self.viewfield_step}"
+
+        elif self.sensor_array_type == "lidar":
+            if self.sensor_array_params is None:
+                self.ray_num = 7  # number of rays per side
+                self.ray_step = 15  # distance between sensors along a ray
+                self.ray_sensors_per_ray = 20  # number of sensors along a ray
+                self.ray_max_angle = 70  # angle to sweep left/right
+            else:
+                self.ray_num = self.sensor_array_params["ray_num"]
+                self.ray_step = self.sensor_array_params["ray_step"]
+                self.ray_sensors_per_ray = self.sensor_array_params["ray_sensors_per_ray"]
+                self.ray_max_angle = self.sensor_array_params["ray_max_angle"]
+
+            self.tot_ray_num = self.ray_num * 2 + 1
+            self.ray_angle = self.ray_max_angle / self.ray_num
+            sensor_key = f"{self.ray_num} {self.ray_step}"
+            sensor_key += f" {self.ray_sensors_per_ray} {self.ray_max_angle}"
+            return sensor_key
+
+        else:
+            raise ValueError(f"Unknown sensor_array_type {self.sensor_array_type}")
 
-    def get_current_sensor_array(self):
+    def get_current_sensor_array(self, out=None):
         """returns the translated sensor array to use
+
+        if out is given the array is written there, without allocating
         """
         base_sa = self.all_sensor_array[self.direction]
-        car_pos = np.array((self.pos_x, self.pos_y))
-        translated_sa = np.add(base_sa, car_pos)
+        self.car_pos[0] = self.pos_x
+        self.car_pos[1] = self.pos_y
+        translated_sa = np.add(base_sa, self.car_pos, out=out)
         return translated_sa
 
     def _create_sensor_array_template(self):
         """create the template for the sensor array
 
+        the params are set by _set_sensor_array_params
         in a convenient shape to rotate it:
         diamond:
             * has shape (2, viewfield_size^2)
@@ -186,13 +281,6 @@ class RacerCar(Sprite):
         #  logg.debug(f"Start _create_sensor_array_template")
 
         if self.sensor_array_type == "diamond":
-            if self.sensor_array_params is None:
-                self.viewfield_size = 20  # number of rows/columns in the sensor
-                self.viewfield_step = 10  # spacing between the dots
-            else:
-                self.viewfield_size = self.sensor_array_params["viewfield_size"]
-                self.viewfield_step = self.sensor_array_params["viewfield_step"]
-
             sat = []
             for i in range(0, self.viewfield_size):
                 for j in range(0, self.viewfield_size):
@@ -205,20 +293,6 @@ class RacerCar(Sprite):
             #  logg.debug(f"shape sensor_array_template {sat.shape}")
 
         elif self.sensor_array_type == "lidar":
-            if self.sensor_array_params is None:
-                self.ray_num = 7  # number of rays per side
-                self.ray_step = 15  # distance between sensors along a ray
-                self.ray_sensors_per_ray = 20  # number of sensors along a ray
-                self.ray_max_angle = 70  # angle to sweep left/right
-            else:
-                self.ray_num = self.sensor_array_params["ray_num"]
-                self.ray_step = self.sensor_array_params["ray_step"]
-                self.ray_sensors_per_ray = self.sensor_array_params["ray_sensors_per_ray"]
-                self.ray_max_angle = self.sensor_array_params["ray_max_angle"]
-
-            self.tot_ray_num = self.ray_num * 2 + 1
-            self.ray_angle = self.ray_max_angle / self.ray_num
-
             # create the horizontal ray
             base_ray = tuple((s, 0) for s in range(1, self.ray_sensors_per_ray + 1))
             base_ray = np.array(base_ray).transpose() * self.ray_step
@@ -250,7 +324,7 @@ class RacerCar(Sprite):
         self.rect.center = self.pos_x, self.pos_y
 
         # undate the image attribute only if it needs to be shown
-        if self.render_mode == "human":
+        if self.render_mode in ("human", "rgb_array"):
             # pick the correct image and place it
             self.image = self.rot_car_image[self.direction]
 
@@ -276,13 +350,18 @@ class RacerCar(Sprite):
         car_top = w_radius
         car_left = ceil(car_wid / 2)
         car_size = car_len + car_wid, car_wid + w_wid
+        self.car_size = car_size
+
+        if self.render_mode in ("human", "rgb_array"):
+            # pygame is imported only when the car has to be drawn
+            import pygame
 
-        if self.render_mode == "human":
             # create a surf just big enough for the car
-            car_surf = Surface(car_size)
-            # convert the surface for fastest blitting
-            # same pixel format as the display Surface
-            car_surf = car_surf.convert()
+            car_surf = pygame.Surface(car_size)
+            if self.render_mode == "human":
+                # convert the surface for fastest blitting
+                # same pixel format as the display Surface
+                car_surf = car_surf.convert()
 
             black = (0, 0, 0)
             car_surf.fill(black)
@@ -341,10 +420,8 @@ class RacerCar(Sprite):
 
         elif self.render_mode == "console":
             # if the render_mode is console, only the rect are needed (to
-            # collide with the road) so an empty surface as big as the car is
-            # enough, and will be only used to create the rotated rectangles
-            car_surf = Surface(car_size)
-            self.orig_image = car_surf
+            # collide with the road) and they are computed from car_size
+            pass
 
         else:
             raise ValueError(f"Unknown render mode {self.render_mode}")
@@ -356,6 +433,8 @@ class RacerCar(Sprite):
         top left is for the rectangle
         width is the height, length is the width lol
         """
+        import pygame
+
         # make width even to simplify things
         if width % 2 != 0:
             width += 1
@@ -372,14 +451,47 @@ class RacerCar(Sprite):
 
     def _rotate_car_image(self):
         """Create rotated copies of the surface
+
+        the rects are computed analytically, the same size that
+        pygame.transform.rotate would give, so no surface is needed for them
+
+        the sizes of the rects and the images are shared in the process, but
+        each car has its own rects, as they are moved around
         """
         #  logg = logging.getLogger(f"c.{__name__}._rotate_car_image")
         #  logg.info(f"Start _rotate_car_image")
         #  if 360 % self.dir_step != 0:
         #  logg.warn(f"A dir_step that is not divisor of 360 is a bad idea")
 
-        self.rot_car_image = {}
+        key = f"{self.car_size} {self.dir_step}"
+        tables = cached_tables(
+            "car_rect", key, self._build_rect_tables, self.disk_cache, self.cache_dir
+        )
+        self.rect_tables = tables
+        rot_car_size = tables["rot_car_size"].tolist()
+
         self.rot_car_rect = {}
+        for dir_id, dire in enumerate(range(0, 360, self.dir_step)):
+            rot_wid, rot_hei = rot_car_size[dir_id]
+            self.rot_car_rect[dire] = Rect(0, 0, rot_wid, rot_hei)
+
+        self.rot_car_image = {}
+        if self.render_mode in ("human", "rgb_array"):
+            # the images converted for the display are kept apart
+            image_key = (self.dir_step, self.render_mode)
+            if image_key not in _ROT_IMAGE_CACHE:
+                from pygame.transform import rotate
+
+                rot_car_image = {}
+                for dire in range(0, 360, self.dir_step):
+                    rot_car_image[dire] = rotate(self.orig_image, dire)
+                _ROT_IMAGE_CACHE[image_key] = rot_car_image
+            self.rot_car_image = _ROT_IMAGE_CACHE[image_key]
+
+    def _build_rect_tables(self):
+        """the size of the rotated car rect for all possible directions
+        """
+        rot_car_size = []
         for dire in range(0, 360, self.dir_step):
-            self.rot_car_image[dire] = rotate(self.orig_image, dire)
-            self.rot_car_rect[dire] = self.rot_car_image[dire].get_rect()
+            rot_car_size.append(rotated_size(*self.car_size, dire))
+        return {"rot_car_size": np.array(rot_car_size, dtype=np.int64)}
@@ -0,0 +1,124 @@
+import numpy as np
+
+# the neighbour cells searched from each cell (dx, dy): half of the 8
+# neighbours, so that each pair of cells is checked only once
+NEIGHBOUR_CELLS = [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]
+
+
+class CarSpatialHash:
+    """Broad phase for the contacts between many cars
+
+    The cars are put in a grid of cells as big as the largest car rect, by
+    the cell of their center: two cars can touch only if their cells are the
+    same or next to each other. The cars are sorted by cell, so each cell is
+    a run in the sorted order, found with searchsorted. The order of the
+    last call is kept and sorted again, as the cars move only a little in a
+    step and a stable sort of nearly sorted keys is fast.
+
+    The cost grows with the number of cars and of close pairs, not with the
+    number of all pairs.
+    """
+
+    def __init__(self, cell_size):
+        """
+        cell_size: at least the largest width or height of a car rect
+        """
+        self.cell_size = cell_size
+        self.order = None
+
+    def candidate_pairs(self, pos_x, pos_y):
+        """the pairs of cars that are close enough to touch
+
+        pos_x, pos_y: int arrays with the centers of the cars
+
+        returns two arrays first, second with the ids of the cars in each
+        pair, every pair is present once
+        """
+        num_cars = len(pos_x)
+        if num_cars == 0:
+            no_pairs = np.zeros(0, dtype=np.int64)
+            return no_pairs, no_pairs
+
+        cell_x = pos_x // self.cell_size
+        cell_y = pos_y // self.cell_size
+        # a key for each cell, with room for the neighbours of the border
+        cell_x = cell_x - cell_x.min() + 1
+        cell_y = cell_y - cell_y.min() + 1
+        num_y = int(cell_y.max()) + 2
+        cell_key = cell_x * num_y + cell_y
+
+        # sort the cars by cell, starting from the order of the last step
+        if self.order is None or len(self.order) != num_cars:
+            self.order = np.arange(num_cars)
+        resort = np.argsort(cell_key[self.order], kind="stable")
+        self.order = self.order[resort]
+        sorted_key = cell_key[self.order]
+
+        # the position of each car in the sorted order
+        rank = np.empty(num_cars, dtype=np.int64)
+        rank[self.order] = np.arange(num_cars)
+
+        # the run of sorted cars in each neighbour cell of each car
+        all_first = []
+        all_lo = []
+        all_hi = []
+        for dx, dy in NEIGHBOUR_CELLS:
+            query = cell_key + (dx * num_y + dy)
+            hi = np.searchsorted(sorted_key, query, side="right")
+            if dx == 0 and dy == 0:
+                # in the same cell only the cars after this one
+                lo = rank + 1
+            else:
+                lo = np.searchsorted(sorted_key, query, side="left")
+            all_first.append(np.arange(num_cars))
+            all_lo.append(lo)
+            all_hi.append(hi)
+        first = np.concatenate(all_first)
+        lo = np.concatenate(all_lo)
+        counts = np.maximum(np.concatenate(all_hi) - lo, 0)
+
+        # expand the runs into pairs
+        total = int(counts.sum())
+        run_start = np.cumsum(counts) - counts
+        in_run = np.arange(total) - np.repeat(run_start, counts)
+        second = self.order[np.repeat(lo, counts) + in_run]
+        first = np.repeat(first, counts)
+
+        return first, second
+
+
+def overlapping_pairs(first, second, left, top, width, height):
+    """the narrow phase, keep the pairs where the car rects overlap
+
+    touching edges do not count, like Rect.colliderect
+
+    returns the filtered first, second
+    """
+    overlap = (
+        (left[first] < left[second] + width[second])
+        & (left[second] < left[first] + width[first])
+        & (top[first] < top[second] + height[second])
+        & (top[second] < top[first] + height[first])
+    )
+    return first[overlap], second[overlap]
+
+
+def car_contacts(spatial_hash, pos_x, pos_y, width, height):
+    """find the cars that touch another car
+
+    pos_x, pos_y: the centers of the car rects
+    width, height: the sizes of the car rects
+
+    returns a bool array, True for the cars in contact
+    """
+    # the rects are placed like Rect.center does
+    left = pos_x - width // 2
+    top = pos_y - height // 2
+
+    first, second = spatial_hash.candidate_pairs(pos_x, pos_y)
+    first, second = overlapping_pairs(first, second, left, top, width, height)
+
+    contacts = np.zeros(len(pos_x), dtype=bool)
+    contacts[first] = True
+    contacts[second] = True
+    return contacts
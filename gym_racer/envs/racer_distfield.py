@@ -0,0 +1,102 @@
+import numpy as np
+
+# the truncated sensor positions are less than this further apart than the
+# exact ones, it is larger than sqrt(2) to also cover the float rounding
+SENSOR_SLACK = 1.5
+
+
+class DistanceFieldLidar:
+    """Lidar that sphere traces the rays in the distance field of the road
+
+    The sensors of each ray are still the ones of the sensor array, but
+    they are not all checked: if the sensor in use is at distance d from the
+    nearest pixel off the road (RacerMap.dist_field), all the next sensors
+    closer than d are on the road, and are skipped. In the open road a ray
+    jumps many sensors at once, near the border it checks them one by one.
+
+    The obs is the same of the sampled lidar, for any road, also the tracks
+    loaded from an occupancy map, and the number of steps does not grow with
+    ray_sensors_per_ray in the open road.
+    """
+
+    def __init__(self, racer_car, racer_map):
+        """
+        racer_car: a lidar RacerCar, for the rays and dir_step
+        racer_map: the RacerMap, its distance field is built if needed
+        """
+        if racer_car.sensor_array_type != "lidar":
+            raise ValueError("The distance field lidar only works with the lidar")
+
+        self.ray_step = racer_car.ray_step
+        self.ray_sensors_per_ray = racer_car.ray_sensors_per_ray
+
+        # the sensors, shape (num_dirs, tot_ray_num, ray_sensors_per_ray, 2)
+        all_dirs = range(0, 360, racer_car.dir_step)
+        dir_rays = np.stack([racer_car.all_sensor_array[dire] for dire in all_dirs])
+        dir_rays = dir_rays.astype(np.int64)
+
+        # the field is padded so that the sensors of a car clipped to
+        # [-max_off - 1, field_size + max_off] are always inside it
+        racer_map.precompute_distance_field()
+        dist_field = racer_map.dist_field
+        max_off = int(np.abs(dir_rays).max())
+        self.pad = 2 * max_off + 1
+        self.min_pos = -max_off - 1
+        self.max_x = dist_field.shape[0] + max_off
+        self.max_y = dist_field.shape[1] + max_off
+        pad_field = np.pad(dist_field, self.pad)
+        self.pad_hei = pad_field.shape[1]
+
+        # the number of sensors to move along the ray from each pixel, all
+        # the sensors closer than dist - SENSOR_SLACK are on the road, 0 off
+        # the road
+        skip = np.floor((pad_field - SENSOR_SLACK) / self.ray_step)
+        np.clip(skip + 1, 1, self.ray_sensors_per_ray, out=skip)
+        skip[pad_field == 0] = 0
+        self.skip_field = skip.astype(np.uint8).ravel()
+
+        # the flat offset of the sensors in the padded field
+        self.dir_rays = dir_rays[..., 0] * self.pad_hei + dir_rays[..., 1]
+
+    def lookup(self, pos_x, pos_y, dir_id, out=None):
+        """the lidar obs of a car in that pose
+
+        the obs has the format of RacerEnv._analyze_collisions: for each ray
+        the index of the first sensor off the road; pos_x, pos_y, dir_id can
+        also be arrays of the same shape, the obs has shape (..., tot_ray_num)
+
+        if out is given the obs is written there, without allocating
+        """
+        rays = self.dir_rays[dir_id]
+        obs_shape = rays.shape[:-1]
+        ray_rows = rays.reshape(-1, self.ray_sensors_per_ray)
+
+        # the flat position of the car in the padded field, for each ray
+        car_x = np.clip(pos_x, self.min_pos, self.max_x) + self.pad
+        car_y = np.clip(pos_y, self.min_pos, self.max_y) + self.pad
+        car_flat = np.asarray(car_x * self.pad_hei + car_y)[..., None]
+        car_flat = np.broadcast_to(car_flat, obs_shape).ravel()
+
+        # the sensor to check on each ray, until the first off the road
+        first_off = np.zeros(len(ray_rows), dtype=np.int64)
+        # the rays still traced
+        tracing = np.arange(len(ray_rows))
+
+        while len(tracing) > 0:
+            sensor_id = first_off[tracing]
+            flat_pos = ray_rows[tracing, sensor_id] + car_flat[tracing]
+            skip = self.skip_field[flat_pos]
+
+            # stop on the sensors off the road, jump over the ones on it
+            on_road = skip > 0
+            tracing = tracing[on_road]
+            sensor_id = sensor_id[on_road] + skip[on_road]
+            first_off[tracing] = sensor_id
+            tracing = tracing[sensor_id < self.ray_sensors_per_ray]
+
+        np.minimum(first_off, self.ray_sensors_per_ray, out=first_off)
+        first_off = first_off.reshape(obs_shape)
+        if out is None:
+            return first_off.astype(np.uint8)
+        np.copyto(out, first_off, casting="unsafe")
+        return out
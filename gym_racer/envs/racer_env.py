@@ -1,25 +1,96 @@
 import numpy as np
+from collections import OrderedDict
 from random import choice
+from random import getstate
+from random import randrange
+from random import setstate
 
 #  from timeit import default_timer as timer
 
 import gym
 from gym import spaces
 
-import pygame
-from pygame.sprite import spritecollide
-
+from gym_racer.envs.racer_analytic import AnalyticLidar
+from gym_racer.envs.racer_atlas import LidarAtlas
+from gym_racer.envs.racer_distfield import DistanceFieldLidar
 from gym_racer.envs.racer_car import RacerCar
 from gym_racer.envs.racer_map import RacerMap
+from gym_racer.envs.racer_profiler import PhaseProfiler
+from gym_racer.envs.racer_sensor import SensorCollider
+from gym_racer.envs.racer_track import load_track
 
 #  from gym_racer.envs.utils import getMyLogger
 
 
+class RacerState:
+    """The mutable state of a RacerEnv, see RacerEnv.get_state
+
+    the pose of the car, the map in use and the state of the random module
+    """
+
+    __slots__ = (
+        "pos_x",
+        "pos_y",
+        "precise_x",
+        "precise_y",
+        "direction",
+        "speed",
+        "track_id",
+        "flip_segments",
+        "rng_state",
+    )
+
+    def __init__(
+        self,
+        pos_x,
+        pos_y,
+        precise_x,
+        precise_y,
+        direction,
+        speed,
+        track_id,
+        flip_segments,
+        rng_state,
+    ):
+        self.pos_x = pos_x
+        self.pos_y = pos_y
+        self.precise_x = precise_x
+        self.precise_y = precise_y
+        self.direction = direction
+        self.speed = speed
+        self.track_id = track_id
+        self.flip_segments = flip_segments
+        self.rng_state = rng_state
+
+    def __repr__(self):
+        info_str = f"<RacerState(pos ({self.pos_x}, {self.pos_y})"
+        info_str += f" dir {self.direction} speed {self.speed}"
+        info_str += f" track {self.track_id} flip {self.flip_segments})>"
+        return info_str
+
+
 class RacerEnv(gym.Env):
-    metadata = {"render.modes": ["human", "console"]}
+    metadata = {"render.modes": ["human", "rgb_array", "console"]}
     reward_range = (-float("inf"), float("inf"))
     # TODO how to advertise sensor_array_type properly?
 
+    # the number of rendered texts kept for the sidebar
+    text_cache_size = 256
+
+    # the phases timed by the profiler
+    profile_phases = [
+        "step_car",
+        "step_reward",
+        "step_collide",
+        "step_analyze",
+        "step",
+        "reset_car",
+        "reset_collide",
+        "reset_analyze",
+        "reset",
+        "render",
+    ]
+
     def __init__(
         self,
         sensor_array_type="lidar",
@@ -27,8 +98,41 @@ class RacerEnv(gym.Env):
         sensor_array_params=None,
         dir_step=3,
         speed_step=1,
+        sensor_engine="numpy",
+        cache_dir=None,
+        disk_cache=False,
+        track=None,
+        track_pool=None,
+        pool_cache_size=8,
+        profile=False,
+        profile_info=False,
     ):
         """
+
+        sensor_engine selects how the sensor array is collided with the road:
+            * numpy: the whole array is collided with one gather in raw_map
+            * python: the original loop over every sensor, for comparison
+            * atlas: the lidar obs is read from a precomputed LidarAtlas
+            * analytic: the lidar rays are intersected with the rects of the
+              road segments, see AnalyticLidar
+            * distfield: the lidar rays are sphere traced in the distance
+              field of the road, see DistanceFieldLidar
+
+        cache_dir is where the precomputed data is saved, see get_cache_dir
+        disk_cache also saves there the sensor arrays and the heading layers,
+        that are always shared by all the envs in the process
+
+        track is a Track or the path of a track json, see load_track; the
+        field has the size of the track, None uses the original ring
+        track_pool is a list of tracks (or paths), at each reset one is picked
+        at random; the maps are built the first time each track is used
+        pool_cache_size is how many maps of the pool are kept, the least
+        recently used is dropped when a new one is built, and built again
+        (or opened from the cache dir with disk_cache) if it is used later
+
+        profile enables the PhaseProfiler, that times each phase of step,
+        reset and render, read the stats with get_profile; if profile_info is
+        True the times of the last step are also put in info["profile"]
         """
         #  logg = getMyLogger(f"c.{__class__.__name__}.__init__")
         #  logg.info(f"Start init RacerEnv")
@@ -38,10 +142,52 @@ class RacerEnv(gym.Env):
         self.sensor_array_type = sensor_array_type
         self.render_mode = render_mode
         self.sensor_array_params = sensor_array_params
+        self.sensor_engine = sensor_engine
+        self.cache_dir = cache_dir
+        self.disk_cache = disk_cache
+
+        # the profiler of the phases, None when disabled
+        self.profile_info = profile_info
+        if profile:
+            self.profiler = PhaseProfiler(self.profile_phases)
+            self.phase_clock = self.profiler.clock
+        else:
+            self.profiler = None
+            # a clock that always returns 0, cheaper than a no op function
+            self.phase_clock = int
+
+        # the layout of the road
+        if isinstance(track, str):
+            track = load_track(track)
+        self.track = track
+
+        # the tracks to pick from at each reset
+        self.track_pool = None
+        if track_pool is not None:
+            self.track_pool = []
+            for pool_track in track_pool:
+                if isinstance(pool_track, str):
+                    pool_track = load_track(pool_track)
+                self.track_pool.append(pool_track)
+            self.track = self.track_pool[0]
+            field_sizes = set(pool_track.field_size for pool_track in self.track_pool)
+            if len(field_sizes) > 1:
+                info_str = "All the tracks in track_pool must have the same field_size"
+                raise ValueError(info_str)
+            if sensor_engine == "atlas":
+                raise ValueError("The atlas sensor_engine works with a single track")
+            if pool_cache_size < 1:
+                raise ValueError("The pool_cache_size must be at least 1")
+            # the maps of the tracks used last, in order of use
+            self.pool_cache_size = pool_cache_size
+            self.pool_maps = OrderedDict()
 
         # racing field dimensions
-        self.field_wid = 900
-        self.field_hei = 900
+        if self.track is None:
+            self.field_wid = 900
+            self.field_hei = 900
+        else:
+            self.field_wid, self.field_hei = self.track.field_size
         self.field_size = (self.field_wid, self.field_hei)
 
         # sidebar info dimensions
@@ -64,25 +210,46 @@ class RacerEnv(gym.Env):
             sensor_array_type=self.sensor_array_type,
             render_mode=self.render_mode,
             sensor_array_params=self.sensor_array_params,
+            disk_cache=self.disk_cache,
+            cache_dir=self.cache_dir,
         )
 
-        # add the car to the list of sprites to render
-        self.allsprites = pygame.sprite.RenderPlain((self.racer_car))
-
         # setup the road
         self.racer_map = RacerMap(
-            self.field_wid, self.field_hei, render_mode=self.render_mode
+            self.field_wid,
+            self.field_hei,
+            render_mode=self.render_mode,
+            track=self.track,
+            disk_cache=self.disk_cache,
+            cache_dir=self.cache_dir,
         )
 
+        # the track of the pool in use, always 0 without a pool
+        self.track_id = 0
+        if self.track_pool is not None:
+            self.pool_maps[0] = self.racer_map
+        else:
+            # the default track can be used flipped or not
+            self.flip_maps = {self.racer_map.flip_segments: self.racer_map}
+
+        # place the car on the first segment, so that step works also before
+        # reset; this is cheap and does not draw from the random generator,
+        # the sensors are collided at the first reset or step
+        direction, pos_x, pos_y = self.racer_map.seg_info[0]
+        self.racer_car.reset(pos_x, pos_y, direction)
+
+        # setup the buffers of the sensor engine
+        self._setup_sensor_engine()
+
+        # the heavy precomputed data is built at the first reset or step
+        self.precomputed = False
+
         # finish setup pygame environment
         self._finish_setup_pygame()
 
         # Define action and observation space
         self._setup_action_obs_space()
 
-        # MAYBE this is called by the user to get the first obs anyway
-        self.reset()
-
     def step(self, action):
         """Perform the action
 
@@ -114,27 +281,78 @@ class RacerEnv(gym.Env):
         #  logg = getMyLogger(f"c.{__class__.__name__}.step")
         #  logg.info(f"Start env step, action: '{action}'")
 
+        obs = np.empty(self.obs_shape, dtype=np.uint8)
+        reward, done, info = self.step_into(action, obs)
+
+        return obs, reward, done, dict(info)
+
+    def step_into(self, action, obs_out):
+        """Perform the action, writing the obs in obs_out
+
+        obs_out is a uint8 array with the shape of the obs returned by step
+        returns reward, done, info; info is the same dict at every call
+
+        All the work is done in preallocated buffers, so in the hot loop no
+        array is allocated.
+        """
+        if not self.precomputed:
+            self._setup_precomputed()
+
+        # the phases are timed only if the profiler is enabled
+        clock = self.phase_clock
+
         # update the car
+        t0 = clock()
         self.racer_car.step(action)
 
         # compute the reward for this action
+        t1 = clock()
         reward, done = self._compute_reward()
 
         # get collisions from sensor array
+        t2 = clock()
         self._collide_sensor_array()
 
         # analyze the collisions
-        obs = self._analyze_collisions()
+        t3 = clock()
+        self._analyze_collisions(obs_out)
+        t4 = clock()
 
         # create recap of env state
-        info = {
-            "car_pos_x": self.racer_car.pos_x,
-            "car_pos_y": self.racer_car.pos_y,
-            "car_dir": self.racer_car.direction,
-            "car_speed": self.racer_car.speed,
-        }
+        info = self.info
+        info["car_pos_x"] = self.racer_car.pos_x
+        info["car_pos_y"] = self.racer_car.pos_y
+        info["car_dir"] = self.racer_car.direction
+        info["car_speed"] = self.racer_car.speed
+
+        profiler = self.profiler
+        if profiler is not None:
+            t5 = clock()
+            profiler.record("step_car", t1 - t0)
+            profiler.record("step_reward", t2 - t1)
+            profiler.record("step_collide", t3 - t2)
+            profiler.record("step_analyze", t4 - t3)
+            profiler.record("step", t5 - t0)
+            if self.profile_info:
+                info["profile"] = profiler.last_times()
+
+        return reward, done, info
+
+    def get_profile(self):
+        """the stats of the phases recorded by the profiler
+
+        returns a dict phase: stats, see PhaseProfiler.summary
+        """
+        if self.profiler is None:
+            info_str = "The profiler is disabled, create the env with profile=True"
+            raise ValueError(info_str)
+        return self.profiler.summary()
 
-        return obs, reward, done, info
+    def reset_profile(self):
+        """forget the times recorded by the profiler
+        """
+        if self.profiler is not None:
+            self.profiler.reset()
 
     def reset(self):
         """Reset the state of the environment to an initial state
@@ -142,22 +360,181 @@ class RacerEnv(gym.Env):
         #  logg = getMyLogger(f"c.{__class__.__name__}.reset")
         #  logg.debug(f"Start reset")
 
+        if not self.precomputed:
+            self._setup_precomputed()
+
+        # drive on a random track of the pool
+        if self.track_pool is not None:
+            self._switch_track(randrange(len(self.track_pool)))
+
+        # the phases are timed only if the profiler is enabled
+        clock = self.phase_clock
+
         #  pick a random segment of the map and place the car there
+        t0 = clock()
         direction, pos_x, pos_y = choice(self.racer_map.seg_info)
         self.racer_car.reset(pos_x, pos_y, direction)
 
         # get collisions from sensor array
+        t1 = clock()
         self._collide_sensor_array()
 
         # analyze the collisions
-        return self._analyze_collisions()
+        t2 = clock()
+        obs = self._analyze_collisions()
+
+        profiler = self.profiler
+        if profiler is not None:
+            t3 = clock()
+            profiler.record("reset_car", t1 - t0)
+            profiler.record("reset_collide", t2 - t1)
+            profiler.record("reset_analyze", t3 - t2)
+            profiler.record("reset", t3 - t0)
+
+        return obs
+
+    def get_state(self, rng=True):
+        """capture the state of the env, to restore it later with set_state
+
+        only the car pose and the map in use are saved, the tables are shared;
+        if rng is True the state of the random module, used by reset, is
+        saved too, that takes most of the time of get_state and set_state
+
+        returns a RacerState
+        """
+        racer_car = self.racer_car
+        rng_state = getstate() if rng else None
+        return RacerState(
+            racer_car.pos_x,
+            racer_car.pos_y,
+            racer_car.precise_x,
+            racer_car.precise_y,
+            racer_car.direction,
+            racer_car.speed,
+            self.track_id,
+            self.racer_map.flip_segments,
+            rng_state,
+        )
+
+    def set_state(self, state):
+        """restore a state saved by get_state
+
+        the obs is not computed, the next step returns the one of the new
+        state; a state can be restored many times, also in other envs created
+        with the same params
+        """
+        if not self.precomputed:
+            self._setup_precomputed()
+
+        self._set_map(state.track_id, state.flip_segments)
+        self.racer_car.set_state(
+            state.pos_x,
+            state.pos_y,
+            state.precise_x,
+            state.precise_y,
+            state.direction,
+            state.speed,
+        )
+        if state.rng_state is not None:
+            setstate(state.rng_state)
+
+        # the sensors of the new pose are computed only if they are drawn
+        self.sa_collided = False
+
+    def _switch_track(self, track_id):
+        """use the map of that track of the pool, building it if needed
+        """
+        if track_id not in self.pool_maps:
+            racer_map = RacerMap(
+                self.field_wid,
+                self.field_hei,
+                render_mode=self.render_mode,
+                track=self.track_pool[track_id],
+                disk_cache=self.disk_cache,
+                cache_dir=self.cache_dir,
+            )
+            racer_map.precompute_heading(
+                self.racer_car.rot_car_rect,
+                self.disk_cache,
+                self.cache_dir,
+                lazy_layers=True,
+            )
+            self.pool_maps[track_id] = racer_map
+
+            # drop the least recently used map, and the lidar built for it
+            if len(self.pool_maps) > self.pool_cache_size:
+                _, old_map = self.pool_maps.popitem(last=False)
+                if self.sensor_engine in ("analytic", "distfield"):
+                    self.ray_lidars.pop(old_map, None)
+        else:
+            self.pool_maps.move_to_end(track_id)
+
+        if self.racer_map is not self.pool_maps[track_id]:
+            self.racer_map = self.pool_maps[track_id]
+            self.track = self.track_pool[track_id]
+            self.track_id = track_id
+            if self.sensor_engine in ("analytic", "distfield") and self.precomputed:
+                self._setup_ray_lidar()
+            if self.render_mode in ("human", "rgb_array"):
+                self._draw_map()
+
+    def _set_map(self, track_id, flip_segments):
+        """use the map of that track of the pool, flipped or not
+
+        only the default track is flipped, the tracks of the pool never are,
+        see RacerMap
+        """
+        if self.track_pool is not None:
+            self._switch_track(track_id)
+            return
+
+        if flip_segments not in self.flip_maps:
+            racer_map = RacerMap(
+                self.field_wid,
+                self.field_hei,
+                render_mode=self.render_mode,
+                track=self.track,
+                disk_cache=self.disk_cache,
+                cache_dir=self.cache_dir,
+                flip_segments=flip_segments,
+            )
+            racer_map.precompute_heading(
+                self.racer_car.rot_car_rect,
+                self.disk_cache,
+                self.cache_dir,
+                lazy_layers=True,
+            )
+            self.flip_maps[flip_segments] = racer_map
+
+        if self.racer_map is not self.flip_maps[flip_segments]:
+            self.racer_map = self.flip_maps[flip_segments]
+            # the atlas of each map is saved in the cache dir
+            if self.sensor_engine == "atlas" and self.precomputed:
+                self.lidar_atlas = LidarAtlas(
+                    self.racer_car.all_sensor_array,
+                    self.racer_map.raw_map,
+                    self.cache_dir,
+                )
+            elif self.sensor_engine in ("analytic", "distfield") and self.precomputed:
+                self._setup_ray_lidar()
+            if self.render_mode in ("human", "rgb_array"):
+                self._draw_map()
 
     def render(self, mode="console", close=False, reward=None):
         """Render the environment to the screen
+
+        in 'rgb_array' mode returns the frame as an array with shape
+        (field_hei, field_wid + sidebar_wid, 3): if the env is in 'rgb_array'
+        render_mode it is a view of the offscreen buffer, with no copy, that
+        the next render overwrites; if the env is in 'human' mode it is a copy
+        of the screen
         """
         #  logg = getMyLogger(f"c.{__class__.__name__}.render")
         #  logg.debug(f"Start render")
 
+        if self.profiler is not None:
+            start = self.profiler.clock()
+
         if mode == "human" and not self.render_mode == "human":
             info_str = f"You tried to render the env in '{mode}' mode,"
             info_str += f" but the env is in '{self.render_mode}' mode."
@@ -166,25 +543,36 @@ class RacerEnv(gym.Env):
             print(info_str)
             mode = "console"
 
+        if mode == "rgb_array" and self.render_mode == "console":
+            info_str = f"You tried to render the env in '{mode}' mode,"
+            info_str += f" but the env is in '{self.render_mode}' mode."
+            info_str += f"\nCreate a new env if you want to render the frames."
+            info_str += f"\nI'll render as 'console'."
+            print(info_str)
+            mode = "console"
+
+        frame = None
         if mode == "human":
-            # Draw Everything again, every frame
-            # the background already has the road and sidebar template drawn
-            self.screen.blit(self.background, (0, 0))
+            import pygame
+
+            self._draw_frame(reward)
 
-            # draw all moving sprites (the car) on the screen
-            self.allsprites.draw(self.screen)
-            # if you draw on the field you can easily leave a track
-            #  allsprites.draw(field)
+            # update only the parts of the display that changed
+            pygame.display.update(self.update_rects)
+            self.update_rects = []
 
-            # draw the sensor surface
-            self._draw_sensor_array()
-            self.screen.blit(self.sa_surf, (0, 0))
+        elif mode == "rgb_array":
+            self._draw_frame(reward)
 
-            # update the dynamic sidebar
-            self._update_dynamic_sidebar(reward)
+            if self.render_mode == "rgb_array":
+                frame = self.rgb_frame
+                # there is no display to update
+                self.update_rects = []
+            else:
+                from pygame.surfarray import array3d
 
-            # update the display
-            pygame.display.flip()
+                # array3d is indexed [x, y], the frame [y, x]
+                frame = array3d(self.screen).swapaxes(0, 1)
 
         elif mode == "console":
             info_str = f"State of the env:"
@@ -196,6 +584,65 @@ class RacerEnv(gym.Env):
         else:
             raise ValueError(f"Unknown render mode {mode}")
 
+        if self.profiler is not None:
+            self.profiler.record("render", self.profiler.clock() - start)
+
+        return frame
+
+    def _draw_frame(self, reward=None):
+        """draw the field, the car, the sensors and the sidebar on the screen
+
+        only the rects where the car, the sensors and the sidebar values were
+        drawn in the last frame are restored from the background, so the rest
+        of the screen is left untouched; the whole background is drawn only
+        in the first frame and after the map changes
+
+        the rects that changed are added to update_rects
+        """
+        import pygame
+
+        # the sidebar values are drawn again only if they changed, or if the
+        # car is drawn over them
+        side_values = self._sidebar_values(reward)
+        car_rects = self.drawn_rects[:1]
+        car_rect = self.racer_car.rect
+        car_rects.append(pygame.Rect(car_rect.topleft, car_rect.size))
+        redraw_side = self.full_redraw or side_values != self.side_values
+        for car_rect in car_rects:
+            redraw_side = redraw_side or car_rect.collidelist(self.side_rects) != -1
+
+        if self.full_redraw:
+            # the background already has the road and sidebar template drawn
+            self.screen.blit(self.background, (0, 0))
+            self.update_rects.append(self.screen.get_rect())
+            self.full_redraw = False
+        else:
+            # erase the last frame
+            erase_rects = self.drawn_rects
+            if redraw_side:
+                erase_rects = erase_rects + self.side_rects
+            for rect in erase_rects:
+                self.screen.blit(self.background, rect, rect)
+            self.update_rects.extend(erase_rects)
+
+        # draw the car on the screen
+        car_rect = self.screen.blit(self.racer_car.image, self.racer_car.rect.topleft)
+        # if you draw on the field you can easily leave a track
+        #  field.blit(self.racer_car.image, self.racer_car.rect.topleft)
+
+        # draw the sensor surface, only the part with the sensors
+        sa_rect = self._draw_sensor_array()
+        self.screen.blit(self.sa_surf, sa_rect, sa_rect)
+
+        self.drawn_rects = [car_rect, sa_rect]
+        self.update_rects.extend(self.drawn_rects)
+
+        # update the dynamic sidebar
+        if redraw_side:
+            self.side_values = side_values
+            self.side_rects = self._update_dynamic_sidebar(side_values)
+            self.update_rects.extend(self.side_rects)
+
     def _setup_action_obs_space(self):
         """
         """
@@ -225,67 +672,30 @@ class RacerEnv(gym.Env):
         #  logg = getMyLogger(f"c.{__class__.__name__}._compute_reward")
         #  logg.debug(f"Start _compute_reward")
 
-        # compute collision car/road
+        # find the heading of the road under the car
         #  start = timer()
-        hits = spritecollide(self.racer_car, self.racer_map, dokill=False)
+        racer_car = self.racer_car
+        dir_id = racer_car.direction // self.dir_step
+        heading_code = self.racer_map.heading_code(
+            racer_car.pos_x, racer_car.pos_y, dir_id
+        )
         #  end = timer()
-        #  logg.debug(f"Time for sprite collisions {end-start:.6f} s")
-
-        #  logg.debug(f"hitting {hits}")
-        hit_directions = []
-        hit_sid = []
-        for segment in hits:
-            #  logg.debug(f"hit segment with id {segment.s_id}")
-            hit_directions.append(self.racer_map.seg_info[segment.s_id][0])
-            hit_sid.append(segment.s_id)
+        #  logg.debug(f"Time for road heading {end-start:.6f} s")
 
         # out of the map
-        if len(hit_directions) == 0:
+        if heading_code == self.racer_map.off_road_code:
             return 0, True
 
         # if it is in the map, check that is moving
-        if self.racer_car.speed < 0.0001:
+        if racer_car.speed < 0.0001:
             return -1, False
 
-        # too many hits, your road is weird, cap them at 2 segments
-        elif len(hit_directions) > 2:
-            #  logg.warn(f"Too many segments hit")
-            hit_directions = hit_directions[:2]
-            hit_sid = hit_sid[:2]
-
-        # now hit_directions is either 1 or 2 elements long
-        if len(hit_directions) == 1:
-            mean_direction = hit_directions[0]
-        else:
-            # 135   90  45    140   95  50    130   85  40
-            # 180       0     185       5     175       -5
-            # 225   270 315   230   275 320   220   265 310
-            # 270, 0 have mean 315 = (270+0+360)/2
-            # 270, 180 have mean 225 = (270+180)/2
-            # 0, 90 have mean 45 = (0+90)/2
-            if abs(hit_directions[0] - hit_directions[1]) > 180:
-                mean_direction = (sum(hit_directions) + 360) / 2
-                if mean_direction >= 360:
-                    mean_direction -= 360
-            else:
-                mean_direction = sum(hit_directions) / 2
-
-        error = self.racer_car.direction - mean_direction
-        if error < 0:
-            error += 360
-        if error > 180:
-            error = 360 - error
-        #  logg.debug(f"direction {self.racer_car.direction} has error of {error:.4f}")
-
-        # error goes from 0 (good) to 180 (bad)
-        reward = 90 - error
+        # the direction error, scaled from -1 to 1, is precomputed
         # MAYBE a sigmoid-like shape
-
-        # scale it from -1 to 1
-        reward /= 90
+        reward = self.racer_map.heading_reward[dir_id, heading_code]
 
         # make it proportional to speed squared
-        reward *= self.racer_car.speed * self.racer_car.speed
+        reward *= racer_car.speed * racer_car.speed
 
         return reward, False
 
@@ -295,14 +705,132 @@ class RacerEnv(gym.Env):
         #  logg = getMyLogger(f"c.{__class__.__name__}._collide_sensor_array")
         #  logg.debug(f"Start _collide_sensor_array")
 
+        # the analytic and distfield engines do not use the sensor array,
+        # that is computed only if it is drawn
+        if self.sensor_engine in ("analytic", "distfield"):
+            dir_id = self.racer_car.direction // self.dir_step
+            self.ray_lidar.lookup(
+                self.racer_car.pos_x, self.racer_car.pos_y, dir_id, out=self.lidar_obs
+            )
+            self.sa_collided = False
+            return
+
         # get the current sensor_array to use
-        self.curr_sa = self.racer_car.get_current_sensor_array()
+        self.racer_car.get_current_sensor_array(out=self.curr_sa)
         #  logg.debug(f"shape curr_sa {self.curr_sa.shape}")
 
-        # copy the shape of curr_sa, but with one channel
-        m = self.curr_sa.shape[0]
-        n = self.curr_sa.shape[1]
-        self.sa_collisions = np.zeros((m, n), dtype=np.uint8)
+        self.sa_collided = True
+
+        if self.sensor_engine == "numpy":
+            self.collider.collide(
+                self.curr_sa, self.racer_map.raw_map, out=self.sa_collisions
+            )
+
+        elif self.sensor_engine == "python":
+            self._collide_sensor_array_python()
+
+        elif self.sensor_engine == "atlas":
+            # the obs is read from the atlas, the sensor array is collided
+            # only if the car is out of the field, where there is no atlas
+            dir_id = self.racer_car.direction // self.dir_step
+            atlas_obs = self.lidar_atlas.lookup(
+                self.racer_car.pos_x, self.racer_car.pos_y, dir_id, out=self.lidar_obs
+            )
+            if atlas_obs is None:
+                self.collider.collide(
+                    self.curr_sa, self.racer_map.raw_map, out=self.sa_collisions
+                )
+            else:
+                self.sa_collided = False
+
+        else:
+            raise ValueError(f"Unknown sensor_engine {self.sensor_engine}")
+
+    def _setup_sensor_engine(self):
+        """build the buffers of the sensor_engine
+        """
+        # the buffers for the sensor array and its collisions
+        sa_shape = self.racer_car.all_sensor_array[0].shape[:2]
+        self.curr_sa = np.zeros(sa_shape + (2,), dtype=np.int64)
+        self.sa_collisions = np.zeros(sa_shape, dtype=np.uint8)
+        self.collider = SensorCollider(sa_shape, self.sensor_array_type)
+
+        # the lidar obs is the argmin of the collisions padded with a 0
+        m, n = sa_shape
+        self.pad_collisions = np.zeros((m, n + 1), dtype=np.uint8)
+        self.argmin_obs = np.zeros(m, dtype=np.intp)
+
+        if self.sensor_array_type == "diamond":
+            self.obs_shape = sa_shape
+        else:
+            self.obs_shape = (m,)
+
+        # the dict returned by step_into
+        self.info = {}
+
+        if self.sensor_engine in ("numpy", "python"):
+            pass
+
+        elif self.sensor_engine == "atlas":
+            if self.sensor_array_type != "lidar":
+                raise ValueError("The atlas sensor_engine only works with the lidar")
+            self.lidar_obs = np.zeros(self.obs_shape, dtype=np.uint8)
+
+        elif self.sensor_engine in ("analytic", "distfield"):
+            if self.sensor_array_type != "lidar":
+                info_str = f"The {self.sensor_engine} sensor_engine only works"
+                info_str += " with the lidar"
+                raise ValueError(info_str)
+            self.lidar_obs = np.zeros(self.obs_shape, dtype=np.uint8)
+            # the lidar of each map used, see _setup_ray_lidar
+            self.ray_lidars = {}
+
+        else:
+            raise ValueError(f"Unknown sensor_engine {self.sensor_engine}")
+
+    def _setup_precomputed(self):
+        """build the road heading tables and the data of the sensor_engine
+
+        this is done at the first reset or step, so that creating an env is
+        cheap; the heading layers are painted only when the car first uses
+        them, see RacerMap.precompute_heading
+        """
+        self.racer_map.precompute_heading(
+            self.racer_car.rot_car_rect,
+            self.disk_cache,
+            self.cache_dir,
+            lazy_layers=True,
+        )
+
+        if self.sensor_engine == "atlas":
+            self.lidar_atlas = LidarAtlas(
+                self.racer_car.all_sensor_array, self.racer_map.raw_map, self.cache_dir
+            )
+
+        elif self.sensor_engine in ("analytic", "distfield"):
+            self._setup_ray_lidar()
+
+        self.precomputed = True
+
+    def _setup_ray_lidar(self):
+        """use the lidar of the analytic or distfield engine for the map
+
+        the lidar of each map is built once, and reused when the map is
+        used again
+        """
+        if self.racer_map not in self.ray_lidars:
+            if self.sensor_engine == "analytic":
+                ray_lidar = AnalyticLidar(self.racer_car, self.racer_map)
+            else:
+                ray_lidar = DistanceFieldLidar(self.racer_car, self.racer_map)
+            self.ray_lidars[self.racer_map] = ray_lidar
+        self.ray_lidar = self.ray_lidars[self.racer_map]
+
+    def _collide_sensor_array_python(self):
+        """collide the sensor array with the road one sensor at a time
+        """
+        # reset the collisions
+        self.sa_collisions.fill(0)
 
         # need to collide the entire matrix
         if self.sensor_array_type == "diamond":
@@ -336,62 +864,100 @@ class RacerEnv(gym.Env):
         else:
             raise ValueError(f"Unknown sensor_array_type {self.sensor_array_type}")
 
-    def _analyze_collisions(self):
+    def _analyze_collisions(self, out=None):
         """parse the collision matrix into obs
+
+        if out is given the obs is written there, without allocating
         """
         #  logg = getMyLogger(f"c.{__class__.__name__}._analyze_collisions")
         #  logg.debug(f"Start _analyze_collisions")
 
+        if out is None:
+            out = np.empty(self.obs_shape, dtype=np.uint8)
+
         if self.sensor_array_type == "diamond":
             # return the entire matrix
-            obs = self.sa_collisions
+            np.copyto(out, self.sa_collisions)
+
+        elif self.sensor_array_type == "lidar" and not self.sa_collided:
+            # the obs was read from the atlas or traced by the ray lidar
+            np.copyto(out, self.lidar_obs)
 
         elif self.sensor_array_type == "lidar":
             #  logg.debug(f"shape sa_collisions {self.sa_collisions.shape}")
             #  logg.debug(f"sa_collisions\n{self.sa_collisions}")
 
-            self.zero_strip = np.zeros((self.sa_collisions.shape[0], 1), dtype=np.uint8)
-            #  logg.debug(f"shape zero_strip {self.zero_strip.shape}")
-            pad_collisions = np.hstack((self.sa_collisions, self.zero_strip))
-            #  logg.debug(f"shape pad_collisions {pad_collisions.shape}")
-            #  logg.debug(f"pad_collisions\n{pad_collisions}")
+            # the last column of pad_collisions is always 0
+            n = self.sa_collisions.shape[1]
+            np.copyto(self.pad_collisions[:, :n], self.sa_collisions)
+            #  logg.debug(f"pad_collisions\n{self.pad_collisions}")
 
-            obs = np.argmin(pad_collisions, axis=1)
-            #  logg.debug(f"shape obs {obs.shape}")
-            #  logg.debug(f"obs: {obs}")
+            np.argmin(self.pad_collisions, axis=1, out=self.argmin_obs)
+            np.copyto(out, self.argmin_obs, casting="unsafe")
+            #  logg.debug(f"obs: {out}")
 
         else:
             raise ValueError(f"Unknown sensor_array_type {self.sensor_array_type}")
 
-        return obs
+        return out
 
     def _setup_pygame(self):
         """
+
+        pygame is imported only in 'human' and 'rgb_array' render_mode, in
+        'console' mode the env runs without it
+
+        in 'rgb_array' mode no display is opened: the screen is an offscreen
+        surface that draws directly in the numpy array self.frame
         """
-        if self.render_mode == "human":
-            # start pygame
-            pygame.init()
-            self.screen = pygame.display.set_mode(self.total_size)
-            pygame.display.set_caption("Racer")
+        if self.render_mode in ("human", "rgb_array"):
+            import pygame
+
+            if self.render_mode == "human":
+                # start pygame
+                pygame.init()
+                self.screen = pygame.display.set_mode(self.total_size)
+                pygame.display.set_caption("Racer")
+
+            else:
+                # only the fonts are needed, not the display
+                pygame.font.init()
+                # the BGRA byte order has the same masks of the other surfaces,
+                # so blitting on the screen needs no pixel conversion
+                self.frame = np.zeros((self.total_hei, self.total_wid, 4), np.uint8)
+                self.screen = pygame.image.frombuffer(
+                    self.frame, self.total_size, "BGRA"
+                )
+                # the RGB channels of the frame, a view with no copy
+                self.rgb_frame = self.frame[:, :, 2::-1]
+                # only the changed rects are redrawn, so the frame must not
+                # be changed from outside
+                self.rgb_frame.flags.writeable = False
 
             # create the background that will be redrawn each iteration
-            self.background = pygame.Surface(self.total_size)
-            self.background = self.background.convert()
+            self.background = self._new_surface(self.total_size)
 
             # Create the playing field
-            self.field = pygame.Surface(self.field_size)
-            self.field = self.field.convert()
+            self.field = self._new_surface(self.field_size)
             self.field.fill((0, 0, 0))
 
             # where the info will be
             self._setup_sidebar()
 
             # create the surface for the sensor_array
-            self.sa_surf = pygame.Surface(self.field_size)
-            self.sa_surf = self.sa_surf.convert()
+            self.sa_surf = self._new_surface(self.field_size)
             # black colors will not be blit
             black = (0, 0, 0)
             self.sa_surf.set_colorkey(black)
+            # the rect of sa_surf where the sensors are drawn
+            self.sa_rect = self.sa_surf.get_rect()
+            # the pixels of a sensor marker, created at the first frame
+            self.sa_marker = None
+
+            # the rects drawn in the last frame and the ones to update
+            self.drawn_rects = []
+            self.update_rects = []
+            self.full_redraw = True
 
         elif self.render_mode == "console":
             pass
@@ -399,13 +965,20 @@ class RacerEnv(gym.Env):
         else:
             raise ValueError(f"Unknown render mode {self.render_mode}")
 
-    def _finish_setup_pygame(self):
+    def _new_surface(self, size):
+        """create a Surface, converted to the display format in 'human' mode
+        """
+        import pygame
+
+        surf = pygame.Surface(size)
         if self.render_mode == "human":
-            # draw map on the field, it is static, so there is no need to redraw it every time
-            self.racer_map.draw(self.field)
+            # convert the surface for fastest blitting
+            surf = surf.convert()
+        return surf
 
-            # draw the field (with the map on it) on the background
-            self.background.blit(self.field, (0, 0))
+    def _finish_setup_pygame(self):
+        if self.render_mode in ("human", "rgb_array"):
+            self._draw_map()
 
         elif self.render_mode == "console":
             pass
@@ -413,28 +986,108 @@ class RacerEnv(gym.Env):
         else:
             raise ValueError(f"Unknown render mode {self.render_mode}")
 
+    def _draw_map(self):
+        """draw the map on the field and the field on the background
+        """
+        # draw map on the field, it is static, so there is no need to redraw it every time
+        self.field.fill((0, 0, 0))
+        self.racer_map.draw(self.field)
+
+        # draw the field (with the map on it) on the background
+        self.background.blit(self.field, (0, 0))
+        self.full_redraw = True
+
     def _draw_sensor_array(self):
         """draw the sensor_array on a Surface
+
+        only the rect with the sensors of the last frame is cleared
+
+        returns the rect of the surface that contains the sensors
         """
         #  logg = getMyLogger(f"c.{__class__.__name__}._draw_sensor_array")
         #  logg.debug(f"Start _draw_sensor_array")
+        import pygame
+
+        # the atlas and ray lidar engines do not collide the sensor array, do
+        # it to draw it
+        # the sensor array is also stale after set_state
+        if not self.sa_collided:
+            self.racer_car.get_current_sensor_array(out=self.curr_sa)
+            self.collider.collide(
+                self.curr_sa, self.racer_map.raw_map, out=self.sa_collisions
+            )
+            self.sa_collided = True
 
         black = (0, 0, 0)
-        # reset the Surface
-        self.sa_surf.fill(black)
+        # reset the part of the Surface used in the last frame
+        self.sa_surf.fill(black, self.sa_rect)
 
         the_color = (0, 255, 0)
         the_second_color = (0, 0, 255)
-        color = the_color
         the_size = 2
-        for i, row in enumerate(self.curr_sa):
-            for j, s_pos in enumerate(row):
-                if not self.sa_collisions is None:
-                    if self.sa_collisions[i, j] == 1:
-                        color = the_second_color
-                    else:
-                        color = the_color
-                pygame.draw.circle(self.sa_surf, color, s_pos, the_size)
+
+        # the box around all the sensors, with room for the circles
+        min_x, min_y = self.curr_sa.min(axis=(0, 1)) - the_size - 1
+        max_x, max_y = self.curr_sa.max(axis=(0, 1)) + the_size + 1
+        sa_rect = pygame.Rect(min_x, min_y, max_x - min_x + 1, max_y - min_y + 1)
+        self.sa_rect = sa_rect.clip(self.sa_surf.get_rect())
+
+        if self.sa_marker is None:
+            self.sa_marker = self._create_sensor_marker(the_size)
+        marker_x, marker_y = self.sa_marker
+
+        # the pixels of all the markers, one row for each sensor
+        sa_pos = self.curr_sa.reshape(-1, 2)
+        pix_x = sa_pos[:, 0:1] + marker_x
+        pix_y = sa_pos[:, 1:2] + marker_y
+        sensor_id = np.broadcast_to(np.arange(len(sa_pos))[:, None], pix_x.shape)
+
+        # the pixels inside the surface
+        surf_wid, surf_hei = self.sa_surf.get_size()
+        inside = (pix_x >= 0) & (pix_x < surf_wid) & (pix_y >= 0) & (pix_y < surf_hei)
+        pix_x = pix_x[inside]
+        pix_y = pix_y[inside]
+        sensor_id = sensor_id[inside]
+
+        # where markers overlap the last sensor is drawn on top, like drawing
+        # them in order: in the reversed pixels unique finds the last one
+        pix_flat = pix_x * surf_hei + pix_y
+        _, last_id = np.unique(pix_flat[::-1], return_index=True)
+        last_id = len(pix_flat) - 1 - last_id
+        pix_x = pix_x[last_id]
+        pix_y = pix_y[last_id]
+        sensor_id = sensor_id[last_id]
+
+        # color the sensors on the road differently
+        mapped_color = self.sa_surf.map_rgb(the_color)
+        mapped_second_color = self.sa_surf.map_rgb(the_second_color)
+        on_road = self.sa_collisions.reshape(-1)[sensor_id] == 1
+        pix_color = np.where(on_road, mapped_second_color, mapped_color)
+
+        # write all the markers at once, the surface is locked while the
+        # pixels array exists
+        pixels = pygame.surfarray.pixels2d(self.sa_surf)
+        pixels[pix_x, pix_y] = pix_color
+        del pixels
+
+        return self.sa_rect
+
+    def _create_sensor_marker(self, the_size):
+        """the offsets of the pixels of a sensor marker from its center
+
+        the marker is drawn once with pygame.draw.circle, so the markers
+        written in bulk are the same as drawing a circle for each sensor
+
+        returns (offset_x, offset_y), arrays with one row
+        """
+        import pygame
+
+        marker_size = 2 * the_size + 3
+        center = the_size + 1
+        marker_surf = pygame.Surface((marker_size, marker_size))
+        pygame.draw.circle(marker_surf, (255, 255, 255), (center, center), the_size)
+        offset_x, offset_y = np.nonzero(pygame.surfarray.array2d(marker_surf))
+        return (offset_x - center)[None, :], (offset_y - center)[None, :]
 
     def _setup_sidebar(self):
         """
@@ -451,8 +1104,7 @@ class RacerEnv(gym.Env):
         self.side_space = 50
 
         # create the sidebar surface
-        self.sidebar_surf = pygame.Surface(self.sidebar_size)
-        self.sidebar_surf = self.sidebar_surf.convert()
+        self.sidebar_surf = self._new_surface(self.sidebar_size)
         self.sidebar_surf.fill(self.sidebar_back_color)
 
         # add titles
@@ -487,63 +1139,100 @@ class RacerEnv(gym.Env):
         self.reward_val_pos = self.sidebar_wid - self.side_space, self.reward_text_hei
 
         # create the dynamic sidebar surface
-        self.side_dyn_surf = pygame.Surface(self.sidebar_size)
-        self.side_dyn_surf = self.side_dyn_surf.convert()
+        self.side_dyn_surf = self._new_surface(self.sidebar_size)
         black = (0, 0, 0)
         self.side_dyn_surf.fill(black)
         self.side_dyn_surf.set_colorkey(black)
+        # the rects of side_dyn_surf where the values are drawn
+        self.side_dyn_rects = []
+        # the values drawn on the screen and where
+        self.side_values = None
+        self.side_rects = []
+        # the rendered texts, the least recently used is dropped first
+        self.text_cache = OrderedDict()
 
         # draw the static sidebar on the background
         self.background.blit(self.sidebar_surf, (self.field_wid, 0))
 
-    def _update_dynamic_sidebar(self, reward=None):
+    def _sidebar_values(self, reward=None):
+        """the texts of the values in the sidebar: speed, direction and reward
+        """
+        if not reward is None:
+            reward_val = f"{reward:.2f}"
+        else:
+            reward_val = f"-"
+        return (f"{self.racer_car.speed}", f"{self.racer_car.direction}", reward_val)
+
+    def _update_dynamic_sidebar(self, side_values):
         """fill the info values in the sidebar
+
+        returns the rects of the screen where the values are drawn
         """
         #  logg = getMyLogger(f"c.{__class__.__name__}._update_dynamic_sidebar")
-        #  logg.info(f"Start _update_dynamic_sidebar with reward {reward}")
+        #  logg.info(f"Start _update_dynamic_sidebar with values {side_values}")
 
-        # reset the Surface
+        # reset the values drawn in the last frame
         black = (0, 0, 0)
-        self.side_dyn_surf.fill(black)
+        for textpos in self.side_dyn_rects:
+            self.side_dyn_surf.fill(black, textpos)
+
+        speed_val, direction_val, reward_val = side_values
 
         # speed text
-        text_info_speed = self.main_font.render(
-            f"{self.racer_car.speed}", 1, self.font_info_color, self.sidebar_back_color,
-        )
+        text_info_speed = self._render_text(speed_val)
         textpos_speed_info = text_info_speed.get_rect(midright=self.speed_val_pos)
         self.side_dyn_surf.blit(text_info_speed, textpos_speed_info)
 
         # direction text
-        text_info_direction = self.main_font.render(
-            f"{self.racer_car.direction}",
-            1,
-            self.font_info_color,
-            self.sidebar_back_color,
-        )
+        text_info_direction = self._render_text(direction_val)
         textpos_direction_info = text_info_direction.get_rect(
             midright=self.direction_val_pos
         )
         self.side_dyn_surf.blit(text_info_direction, textpos_direction_info)
 
         # reward text
-        if not reward is None:
-            reward_val = f"{reward:.2f}"
-        else:
-            reward_val = f"-"
-        text_info_reward = self.main_font.render(
-            reward_val, 1, self.font_info_color, self.sidebar_back_color,
-        )
+        text_info_reward = self._render_text(reward_val)
         textpos_reward_info = text_info_reward.get_rect(midright=self.reward_val_pos)
         self.side_dyn_surf.blit(text_info_reward, textpos_reward_info)
 
-        # draw the filled surface
-        self.screen.blit(self.side_dyn_surf, (self.field_wid, 0))
+        self.side_dyn_rects = [
+            textpos_speed_info,
+            textpos_direction_info,
+            textpos_reward_info,
+        ]
+
+        # draw the values of the filled surface
+        side_rects = []
+        for textpos in self.side_dyn_rects:
+            screen_pos = textpos.move(self.field_wid, 0)
+            side_rects.append(self.screen.blit(self.side_dyn_surf, screen_pos, textpos))
+        return side_rects
+
+    def _render_text(self, text):
+        """render a value for the sidebar
+
+        the last text_cache_size texts rendered are kept, as the font
+        rendering is slow and the values repeat often
+        """
+        text_cache = self.text_cache
+        if text in text_cache:
+            text_cache.move_to_end(text)
+            return text_cache[text]
+
+        text_surf = self.main_font.render(
+            text, 1, self.font_info_color, self.sidebar_back_color
+        )
+        text_cache[text] = text_surf
+        if len(text_cache) > self.text_cache_size:
+            text_cache.popitem(last=False)
+        return text_surf
 
     def _setup_font(self):
         """
         """
         #  logg = getMyLogger(f"c.{__class__.__name__}._setup_font")
         #  logg.info(f"Start _setup_font")
+        import pygame
 
         #  logg.debug(f"all fonts {pygame.font.get_fonts()}")
         #  logg.debug(f"default font {pygame.font.get_default_font()}")
@@ -1,50 +1,77 @@
 import numpy as np
 from random import randint
 
-from pygame import Surface
-from pygame import draw
-from pygame.sprite import Group
-from pygame.sprite import Sprite
-from pygame.transform import rotate
+from gym_racer.envs.racer_cache import cached_tables
+from gym_racer.envs.racer_track import Track
+from gym_racer.envs.racer_track import default_track
 
 #  from gym_racer.envs.utils import getMyLogger
+from gym_racer.envs.utils import Rect
+from gym_racer.envs.utils import rotated_size
 
 
-class RacerMap(Group):
+class RacerMap:
     """Map for a racer, as collection of Segment
 
-    Easy to do collision detection with pygame
+    The segments that overlap with the car are found in the heading layers,
+    with one lookup for any number of segments, see precompute_heading
     A numpy array as big as the field is available to check if a pos is road or not
+    pygame is only needed to draw the map, in 'human' and 'rgb_array'
+    render_mode
+
+    The layout comes from a Track, by default the original ring, that is
+    randomly flipped. The road maps of a track are compiled once and cached,
+    keyed by the content of the track, see cached_tables.
     """
 
-    def __init__(self, field_wid, field_hei, render_mode):
+    def __init__(
+        self,
+        field_wid,
+        field_hei,
+        render_mode,
+        track=None,
+        disk_cache=False,
+        cache_dir=None,
+        flip_segments=None,
+    ):
+        """
+        flip_segments: 1 to flip the default track, 0 to keep it, None to
+        pick at random; other tracks are never flipped
+        """
         #  logg = getMyLogger(f"c.{__name__}.__init__", "INFO")
         #  logg.info(f"Start init RacerMap")
-        super().__init__()
 
         self.field_wid = field_wid
         self.field_hei = field_hei
         self.render_mode = render_mode
+        self.disk_cache = disk_cache
+        self.cache_dir = cache_dir
+
+        # only the default track is flipped
+        if track is None:
+            track = default_track()
+            if flip_segments is None:
+                flip_segments = randint(0, 1)
+        else:
+            flip_segments = 0
+        self.flip_segments = flip_segments
+
+        if track.field_size != (self.field_wid, self.field_hei):
+            info_str = f"The track has field size {track.field_size}"
+            info_str += f", but the map has size {(self.field_wid, self.field_hei)}"
+            raise ValueError(info_str)
 
-        self._create_road_segment()
+        self.segment_wid, self.segment_hei = track.segment_size
+        self.segment_size = self.segment_wid, self.segment_hei
+        self.segment_origs = {}
 
         # direction, centerx, centery
-        self.seg_info = [
-            [0, 200, 100],
-            [270, 450, 200],
-            [0, 550, 450],
-            [270, 800, 550],
-            [180, 700, 800],
-            [180, 350, 800],
-            [90, 100, 700],
-            [90, 100, 350],
-        ]
+        self.seg_info = [list(info) for info in track.seg_info]
+        self.seg_length = list(track.seg_length)
         self.segments = {}
         self.num_segments = len(self.seg_info)
 
         # randomly flip the road, so there is no ring bias
-        flip_segments = randint(0, 1)
-
         if flip_segments:
             for i in range(self.num_segments):
                 # move the segments to preserve structure
@@ -61,76 +88,506 @@ class RacerMap(Group):
                 self.seg_info[i][0] += 180
                 self.seg_info[i][0] %= 360
 
+            # the layout that is actually used
+            segments = []
+            for info, length in zip(self.seg_info, self.seg_length):
+                segments.append(info + [length])
+            track = Track(segments, track.field_size, track.segment_size)
+
+        self.track = track
+
         # create the various segments, with unique id_
         for id_ in range(self.num_segments):
             direction, cx, cy = self.seg_info[id_]
-            self.segments[id_] = Segment(self.segment_orig, direction, cx, cy, id_)
-            # register the segment as a Sprite in the Group
-            self.add(self.segments[id_])
+            segment_size = self.seg_length[id_], self.segment_hei
+            segment_orig = self._create_road_segment(segment_size)
+            self.segments[id_] = Segment(
+                segment_size, direction, cx, cy, id_, segment_orig
+            )
 
         self._precompute_map()
 
-    def _create_road_segment(self):
+    def draw(self, surf):
+        """draw all the segments on the Surface surf
+
+        if the track has an occupancy map, draw that instead
+        """
+        if self.track.occupancy is not None:
+            from pygame import surfarray
+
+            segment_grey = 128
+            road = np.asarray(self.raw_map) * segment_grey
+            road_rgb = np.stack((road, road, road), axis=-1)
+            surf.blit(surfarray.make_surface(road_rgb), (0, 0))
+            return
+
+        for i in self.segments:
+            segment = self.segments[i]
+            surf.blit(segment.image, segment.rect.topleft)
+
+    def precompute_heading(
+        self, rot_car_rect, disk_cache=False, cache_dir=None, lazy_layers=False
+    ):
+        """build the road heading tables for a car with these rotated rects
+
+        rot_car_rect is the dict direction: rect of RacerCar, the directions
+        are indexed in order with dir_id (direction // dir_step)
+
+        The heading of the road under a car depends on the segments that
+        overlap with the car rect: the set of car centers that overlap with a
+        segment is the segment rect grown by the car rect size, so the
+        heading can be precomputed for every pixel, once for every different
+        size of the rotated car rect.
+
+        heading_layers: list of num_layers arrays (layer_wid, layer_hei), the
+            heading code of the road under a car centered on that pixel; the
+            layers start at heading_origin and extend past the field, as a
+            car centered out of the field can still touch the road
+        dir_layer: the heading layer to use for each dir_id
+        heading_values: the mean direction of the road for each heading code,
+            the last code (off_road_code) means that the car is off the road
+        heading_reward: shape (num_dirs, num_codes), the reward for a car
+            with speed 1 for each dir_id and heading code
+
+        With lazy_layers the layers are loaded the first time a car uses
+        them: with disk_cache all of them are opened from the cache dir,
+        else each layer is painted alone, so a single car only pays for the
+        layers of the directions it drives in.
+
+        The tables only depend on the segments and on the car rects, so they
+        are shared by all the maps in the process, see cached_tables
+        """
+        all_dirs = list(rot_car_rect)
+        car_sizes = [(dire, rot_car_rect[dire].size) for dire in all_dirs]
+        seg_rects = [self.segments[i].rect for i in self.segments]
+        seg_sizes = [(rect.topleft, rect.size) for rect in seg_rects]
+        self.heading_key = f"{self.seg_info} {seg_sizes} {car_sizes}"
+        tables = cached_tables(
+            "heading_codes",
+            self.heading_key,
+            lambda: self._build_heading(rot_car_rect),
+            disk_cache,
+            cache_dir,
+        )
+
+        self.heading_tables = tables
+        self.heading_origin = tuple(tables["heading_origin"].tolist())
+        self.layer_sizes = [tuple(size) for size in tables["layer_sizes"].tolist()]
+        self.layer_wid, self.layer_hei = tables["layer_shape"].tolist()
+        self.dir_layer = tables["dir_layer"]
+        self.heading_values = tables["heading_values"]
+        self.off_road_code = int(tables["off_road_code"])
+        self.heading_reward = tables["heading_reward"]
+
+        # the layers, and the TableDict that keeps each one alive
+        self.heading_layers = [None] * len(self.layer_sizes)
+        self.heading_layer_tables = [None] * len(self.layer_sizes)
+        self.heading_stack = None
+        if not lazy_layers:
+            self.precompute_heading_layers(disk_cache, cache_dir)
+
+    def precompute_heading_layers(self, disk_cache=False, cache_dir=None):
+        """build all the heading layers, stacked in heading_stack
+
+        heading_stack: shape (num_layers, layer_wid, layer_hei), used to read
+            the codes of a batch of cars, see heading_code_batch
+        """
+        if self.heading_stack is not None:
+            return
+
+        tables = cached_tables(
+            "heading_layers",
+            self.heading_key,
+            self._build_heading_layers,
+            disk_cache,
+            cache_dir,
+        )
+        self.heading_stack_tables = tables
+        self.heading_stack = tables["heading_layers"]
+        self.heading_layers = list(self.heading_stack)
+
+    def paint_heading_layers(self, out):
+        """write all the heading layers in out, without keeping them
+
+        out: shape (num_layers, layer_wid, layer_hei), uint8; the layers
+        already loaded, or saved in the cache dir with disk_cache, are
+        copied, the others are painted directly in out
+        """
+        if self.heading_stack is None and self.disk_cache:
+            tables = cached_tables(
+                "heading_layers",
+                self.heading_key,
+                self._build_heading_layers,
+                self.disk_cache,
+                self.cache_dir,
+            )
+            out[:] = tables["heading_layers"]
+            return
+
+        missing_ids = []
+        for layer_id, layer in enumerate(self.heading_layers):
+            if layer is not None:
+                out[layer_id] = layer
+            else:
+                missing_ids.append(layer_id)
+        missing_layers = [out[layer_id] for layer_id in missing_ids]
+        self._paint_heading_layers(missing_ids, missing_layers)
+
+    def _build_heading(self, rot_car_rect):
+        """compute the tables of precompute_heading, but the layers
+        """
+        all_dirs = list(rot_car_rect)
+
+        # the first two segments hit, in s_id order: same rule as the reward
+        # each pair (first, second) gets a code, second -1 if only one is hit
+        # the pair is stored as hit state (first+1) * (num_segments+1) + second+1
+        # so that the state 0 means that no segment is hit
+        pair_headings = {}
+        for first in range(self.num_segments):
+            first_dir = self.seg_info[first][0]
+            pair_headings[(first, -1)] = first_dir
+            for second in range(first + 1, self.num_segments):
+                second_dir = self.seg_info[second][0]
+                pair_headings[(first, second)] = mean_direction(first_dir, second_dir)
+
+        # the unique mean directions become the codes
+        heading_values = sorted(set(pair_headings.values()))
+        off_road_code = len(heading_values)
+        state_base = self.num_segments + 1
+        state_code = np.full(state_base * state_base, off_road_code, np.uint8)
+        for (first, second), heading in pair_headings.items():
+            hit_state = (first + 1) * state_base + second + 1
+            state_code[hit_state] = heading_values.index(heading)
+
+        # one layer for each different size of the car rect
+        layer_sizes = []
+        dir_layer = np.zeros(len(all_dirs), dtype=np.int64)
+        for dir_id, dire in enumerate(all_dirs):
+            size = rot_car_rect[dire].size
+            if size not in layer_sizes:
+                layer_sizes.append(size)
+            dir_layer[dir_id] = layer_sizes.index(size)
+
+        # the region where a car can touch a segment
+        max_wid = max(size[0] for size in layer_sizes)
+        max_hei = max(size[1] for size in layer_sizes)
+        all_rects = [self.segments[i].rect for i in self.segments]
+        x_min = min(rect.left for rect in all_rects) - max_wid
+        x_max = max(rect.right for rect in all_rects) + max_wid
+        y_min = min(rect.top for rect in all_rects) - max_hei
+        y_max = max(rect.bottom for rect in all_rects) + max_hei
+        heading_origin = x_min, y_min
+
+        # the error from each direction to each heading
+        num_codes = off_road_code + 1
+        heading_reward = np.zeros((len(all_dirs), num_codes))
+        for dir_id, dire in enumerate(all_dirs):
+            for code, heading in enumerate(heading_values):
+                error = dire - heading
+                if error < 0:
+                    error += 360
+                if error > 180:
+                    error = 360 - error
+                # error goes from 0 (good) to 180 (bad), scale it from -1 to 1
+                heading_reward[dir_id, code] = (90 - error) / 90
+
+        return {
+            "heading_origin": np.array(heading_origin, dtype=np.int64),
+            "layer_shape": np.array((x_max - x_min, y_max - y_min), dtype=np.int64),
+            "layer_sizes": np.array(layer_sizes, dtype=np.int64),
+            "state_code": state_code,
+            "dir_layer": dir_layer,
+            "heading_values": np.array(heading_values + [np.nan]),
+            "off_road_code": np.array(off_road_code, dtype=np.int64),
+            "heading_reward": heading_reward,
+        }
+
+    def _build_heading_layers(self):
+        """compute the stacked layers of precompute_heading_layers
+        """
+        layers_shape = (len(self.layer_sizes), self.layer_wid, self.layer_hei)
+        heading_layers = np.empty(layers_shape, dtype=np.uint8)
+        self._paint_heading_layers(range(len(self.layer_sizes)), heading_layers)
+        return {"heading_layers": heading_layers}
+
+    def _load_heading_layer(self, layer_id):
+        """build a single heading layer, shared by the maps in the process
+
+        with disk_cache all the layers are opened from the cache dir instead
+        """
+        if self.disk_cache:
+            self.precompute_heading_layers(self.disk_cache, self.cache_dir)
+            return self.heading_layers[layer_id]
+
+        def build_layer():
+            layer = np.empty((self.layer_wid, self.layer_hei), dtype=np.uint8)
+            self._paint_heading_layers([layer_id], [layer])
+            return {"heading_layer": layer}
+
+        tables = cached_tables(
+            "heading_layer", f"{self.heading_key} {layer_id}", build_layer
+        )
+        self.heading_layer_tables[layer_id] = tables
+        self.heading_layers[layer_id] = tables["heading_layer"]
+        return tables["heading_layer"]
+
+    def _paint_heading_layers(self, layer_ids, out_layers):
+        """paint the heading codes of the layers in out_layers
+
+        for a car centered on each pixel, the first two s_id hit by the car
+        rect are found, see _build_heading for the encoding of the pair
+        """
+        x_origin, y_origin = self.heading_origin
+        state_base = self.num_segments + 1
+        state_code = self.heading_tables["state_code"]
+
+        # the first and the second s_id + 1 hit, 0 if not hit, reused for
+        # all the layers and cleared only where they are painted
+        first_hit = np.zeros((self.layer_wid, self.layer_hei), dtype=np.uint16)
+        second_hit = np.zeros((self.layer_wid, self.layer_hei), dtype=np.uint16)
+
+        for layer_id, out in zip(layer_ids, out_layers):
+            car_wid, car_hei = self.layer_sizes[layer_id]
+            regions = []
+            for i in range(self.num_segments):
+                rect = self.segments[i].rect
+
+                # the centers where the car rect overlaps with the segment
+                # rect, car left is center - car_wid // 2, like Rect.center
+                x_min = rect.left - (car_wid - car_wid // 2) + 1 - x_origin
+                x_max = rect.right + car_wid // 2 - x_origin
+                y_min = rect.top - (car_hei - car_hei // 2) + 1 - y_origin
+                y_max = rect.bottom + car_hei // 2 - y_origin
+                region = np.s_[x_min:x_max, y_min:y_max]
+                regions.append(region)
+
+                first = first_hit[region]
+                second = second_hit[region]
+                one_hit = (first != 0) & (second == 0)
+                first[first == 0] = i + 1
+                second[one_hit] = i + 1
+
+            # only the pixels near a segment can be on the road
+            out.fill(state_code[0])
+            for region in regions:
+                hit_state = first_hit[region].astype(np.intp)
+                hit_state *= state_base
+                hit_state += second_hit[region]
+                np.take(state_code, hit_state, out=out[region])
+
+            for region in regions:
+                first_hit[region] = 0
+                second_hit[region] = 0
+
+    def heading_code(self, pos_x, pos_y, dir_id):
+        """the heading code of the road under a car
+
+        a car centered out of the heading layers is off the road
+        """
+        layer_x = pos_x - self.heading_origin[0]
+        layer_y = pos_y - self.heading_origin[1]
+        if 0 <= layer_x < self.layer_wid and 0 <= layer_y < self.layer_hei:
+            layer_id = self.dir_layer[dir_id]
+            layer = self.heading_layers[layer_id]
+            if layer is None:
+                layer = self._load_heading_layer(layer_id)
+            return layer[layer_x, layer_y]
+        return self.off_road_code
+
+    def heading_code_batch(self, pos_x, pos_y, dir_id):
+        """the heading code of the road under each car of a batch
+
+        same as heading_code, pos_x, pos_y and dir_id are arrays; all the
+        layers are built, see precompute_heading_layers
+        """
+        if self.heading_stack is None:
+            self.precompute_heading_layers(self.disk_cache, self.cache_dir)
+        layer_x = pos_x - self.heading_origin[0]
+        layer_y = pos_y - self.heading_origin[1]
+        inside = (layer_x >= 0) & (layer_x < self.layer_wid)
+        inside &= (layer_y >= 0) & (layer_y < self.layer_hei)
+        layer_id = self.dir_layer[dir_id]
+        code = self.heading_stack[
+            layer_id, np.where(inside, layer_x, 0), np.where(inside, layer_y, 0)
+        ]
+        return np.where(inside, code, self.off_road_code)
+
+    def _create_road_segment(self, segment_size):
         """Create the bmp for a road segment
+
+        the bmp of each size is created once, None in console render_mode
         """
         #  logg = getMyLogger(f"c.{__name__}._create_road_segment")
 
-        self.segment_wid = 350
-        self.segment_hei = 150
+        if self.render_mode in ("human", "rgb_array"):
+            if segment_size in self.segment_origs:
+                return self.segment_origs[segment_size]
+
+            # pygame is imported only when the map has to be drawn
+            from pygame import Surface
+            from pygame import draw
 
-        if self.render_mode == "human":
+            segment_wid, segment_hei = segment_size
             line_wid = 2
-            mid_hei = self.segment_hei // 2
+            mid_hei = segment_hei // 2
 
-            seg_surf = Surface((self.segment_wid, self.segment_hei))
-            seg_surf = seg_surf.convert()
+            seg_surf = Surface(segment_size)
+            if self.render_mode == "human":
+                seg_surf = seg_surf.convert()
             segment_grey = (128, 128, 128)
             seg_surf.fill(segment_grey)
 
             # Rect(left, top, width, height) -> Rect
             line_white = (255, 255, 255)
-            line_rect = 0, mid_hei - line_wid, self.segment_wid, line_wid
+            line_rect = 0, mid_hei - line_wid, segment_wid, line_wid
             draw.rect(seg_surf, line_white, line_rect)
-            line_rect = self.segment_wid - line_wid, 0, line_wid, self.segment_hei
+            line_rect = segment_wid - line_wid, 0, line_wid, segment_hei
             draw.rect(seg_surf, line_white, line_rect)
 
-            self.segment_orig = seg_surf
+            self.segment_origs[segment_size] = seg_surf
+            return seg_surf
 
         elif self.render_mode == "console":
-            seg_surf = Surface((self.segment_wid, self.segment_hei))
-            self.segment_orig = seg_surf
+            # only the rect of the segments are needed
+            return None
 
         else:
             raise ValueError(f"Unknown render mode {self.render_mode}")
 
     def _precompute_map(self):
         """turn the map into a np array for fast sensor collision lookup
+
+        raw_map: 1 where there is road, 0 elsewhere
+        dist_field: the distance from each pixel to the nearest one off the
+            road, built by precompute_distance_field
+
+        raw_map is compiled once for each track, and shared read only
         """
-        #  MAYBE add a map with s_id in it and do the car/road collision with that
         #  logg = getMyLogger(f"c.{__name__}._precompute_map", "INFO")
         #  logg.debug(f"Start _precompute_map")
 
-        self.raw_map = np.zeros((self.field_wid, self.field_hei), dtype=np.uint8)
-        for i in self.segments:
-            rect = self.segments[i].rect
-            #  logg.debug(f"rect {rect}")
-            #  logg.debug(f"left {rect.left} right {rect.right} top {rect.top} bottom {rect.bottom}")
-            self.raw_map[rect.left : rect.right, rect.top : rect.bottom] = 1
+        tables = cached_tables(
+            "track",
+            self.track.key(),
+            self._build_map,
+            self.disk_cache,
+            self.cache_dir,
+        )
+        self.map_tables = tables
+        self.raw_map = tables["raw_map"]
+
+        self.dist_field = None
+
+    def _build_map(self):
+        """compute raw_map of _precompute_map
+        """
+        raw_map = np.zeros((self.field_wid, self.field_hei), dtype=np.uint8)
+        if self.track.occupancy is not None:
+            raw_map[self.track.occupancy] = 1
+        else:
+            for i in self.segments:
+                rect = self.segments[i].rect
+                #  logg.debug(f"rect {rect}")
+                raw_map[rect.left : rect.right, rect.top : rect.bottom] = 1
+
+        return {"raw_map": raw_map}
 
+    def precompute_distance_field(self):
+        """build the euclidean distance transform of raw_map
 
-class Segment(Sprite):
+        dist_field: shape (field_wid, field_hei), float32, the distance from
+            each pixel to the nearest pixel off the road, 0 off the road; the
+            pixels out of the field count as off the road
+
+        The field is compiled once for each track, like raw_map, and works
+        also for the tracks loaded from an occupancy map
+        """
+        if self.dist_field is not None:
+            return
+
+        tables = cached_tables(
+            "distance",
+            self.track.key(),
+            self._build_distance_field,
+            self.disk_cache,
+            self.cache_dir,
+        )
+        self.distance_tables = tables
+        self.dist_field = tables["dist_field"]
+
+    def _build_distance_field(self):
+        """compute the dist_field of precompute_distance_field
+
+        The exact transform is separable: first the distance to the nearest
+        off road pixel in the same column, then the nearest along the rows,
+        checking the columns k pixels away until k is larger than all the
+        distances found
+        """
+        # a border of off road pixels, for the outside of the field
+        road = np.pad(self.raw_map == 1, 1)
+
+        # the distance along y to the nearest off road pixel of the column
+        pix_y = np.arange(road.shape[1])
+        last_off = np.where(road, 0, pix_y)
+        np.maximum.accumulate(last_off, axis=1, out=last_off)
+        next_off = np.where(road, road.shape[1], pix_y)
+        next_off = np.minimum.accumulate(next_off[:, ::-1], axis=1)[:, ::-1]
+        col_dist = np.minimum(pix_y - last_off, next_off - pix_y)
+
+        # the squared distance, looking in the columns on both sides
+        col_sq = col_dist * col_dist
+        dist_sq = col_sq.copy()
+        shift = 1
+        while shift * shift < dist_sq.max():
+            shift_sq = shift * shift
+            left_sq = dist_sq[:-shift]
+            np.minimum(left_sq, col_sq[shift:] + shift_sq, out=left_sq)
+            right_sq = dist_sq[shift:]
+            np.minimum(right_sq, col_sq[:-shift] + shift_sq, out=right_sq)
+            shift += 1
+
+        dist_field = np.sqrt(dist_sq[1:-1, 1:-1]).astype(np.float32)
+        return {"dist_field": dist_field}
+
+
+def mean_direction(first_dir, second_dir):
+    """the mean of two directions in degrees, along the shortest arc
+    """
+    # 135   90  45    140   95  50    130   85  40
+    # 180       0     185       5     175       -5
+    # 225   270 315   230   275 320   220   265 310
+    # 270, 0 have mean 315 = (270+0+360)/2
+    # 270, 180 have mean 225 = (270+180)/2
+    # 0, 90 have mean 45 = (0+90)/2
+    if abs(first_dir - second_dir) > 180:
+        mean_dir = (first_dir + second_dir + 360) / 2
+        if mean_dir >= 360:
+            mean_dir -= 360
+    else:
+        mean_dir = (first_dir + second_dir) / 2
+    return mean_dir
+
+
+class Segment:
     """A single segment of road
+
+    the image is created only if segment_orig is given
     """
 
-    def __init__(self, segment_orig, direction, cx, cy, s_id):
+    def __init__(self, segment_size, direction, cx, cy, s_id, segment_orig=None):
         #  logg = getMyLogger(f"c.{__name__}.__init__", "INFO")
         #  logg.debug(f"Start init")
-        super().__init__()
 
         self.direction = direction
         self.cx = cx
         self.cy = cy
         self.s_id = s_id
 
-        self.image = rotate(segment_orig, self.direction)
-        self.rect = self.image.get_rect(center=(self.cx, self.cy))
+        rot_wid, rot_hei = rotated_size(*segment_size, self.direction)
+        self.rect = Rect(0, 0, rot_wid, rot_hei)
+        self.rect.center = self.cx, self.cy
+
+        if segment_orig is not None:
+            from pygame.transform import rotate
+
+            self.image = rotate(segment_orig, self.direction)
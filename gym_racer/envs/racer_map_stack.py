@@ -0,0 +1,100 @@
+import numpy as np
+
+
+class RacerMapStack:
+    """The tables of many RacerMap stacked along a first map axis
+
+    The cars of a batch can drive on different maps, each car has a map_id
+    and the road, the segments and the heading of all the cars are read
+    with a single fancy indexing call, indexed by (map_id, x, y).
+
+    The maps must have the same field size and heading tables for the same
+    car, see RacerMap.precompute_heading; the heading layers of the maps are
+    painted directly in the stack, and are not kept by the maps.
+
+    raw_maps: shape (num_maps, field_wid, field_hei)
+    seg_info: shape (num_maps, max_segments, 3), padded with the last
+        segment of each map, num_segments has the real number
+    heading_buffer: the heading layers of all the maps, one map after the
+        other, without padding: the layers of a map start at layer_offset,
+        have shape (num_layers, layer_wid, layer_hei) and cover the field
+        from heading_origin, see RacerMap.precompute_heading
+    heading_reward: shape (num_maps, num_dirs, max_codes)
+    """
+
+    def __init__(self, racer_maps):
+        """
+        racer_maps: list of RacerMap, with the heading tables precomputed
+        """
+        self.num_maps = len(racer_maps)
+
+        field_sizes = set(racer_map.raw_map.shape for racer_map in racer_maps)
+        if len(field_sizes) > 1:
+            raise ValueError("All the maps in a RacerMapStack must have the same size")
+
+        self.raw_maps = np.stack([racer_map.raw_map for racer_map in racer_maps])
+
+        # the segments where the cars start
+        self.num_segments = np.array(
+            [racer_map.num_segments for racer_map in racer_maps]
+        )
+        max_segments = self.num_segments.max()
+        self.seg_info = np.zeros((self.num_maps, max_segments, 3), dtype=np.int64)
+        for map_id, racer_map in enumerate(racer_maps):
+            seg_info = np.array(racer_map.seg_info, dtype=np.int64)
+            self.seg_info[map_id] = seg_info[-1]
+            self.seg_info[map_id, : len(seg_info)] = seg_info
+
+        # the layers only depend on the car rects, that are the same
+        self.dir_layer = racer_maps[0].dir_layer
+        for racer_map in racer_maps:
+            if not np.array_equal(racer_map.dir_layer, self.dir_layer):
+                raise ValueError("The maps have heading layers for different cars")
+        num_layers = len(racer_maps[0].layer_sizes)
+
+        # where the layers of each map are in the buffer
+        self.heading_origin = np.array(
+            [racer_map.heading_origin for racer_map in racer_maps], dtype=np.int64
+        )
+        self.layer_wid = np.array([racer_map.layer_wid for racer_map in racer_maps])
+        self.layer_hei = np.array([racer_map.layer_hei for racer_map in racer_maps])
+        layers_size = num_layers * self.layer_wid * self.layer_hei
+        self.layer_offset = np.zeros(self.num_maps, dtype=np.int64)
+        self.layer_offset[1:] = np.cumsum(layers_size)[:-1]
+
+        self.heading_buffer = np.empty(layers_size.sum(), dtype=np.uint8)
+        for map_id, racer_map in enumerate(racer_maps):
+            start = self.layer_offset[map_id]
+            map_layers = self.heading_buffer[start : start + layers_size[map_id]]
+            layers_shape = (num_layers, racer_map.layer_wid, racer_map.layer_hei)
+            racer_map.paint_heading_layers(map_layers.reshape(layers_shape))
+
+        self.off_road_code = np.array(
+            [racer_map.off_road_code for racer_map in racer_maps]
+        )
+        max_codes = max(racer_map.heading_reward.shape[1] for racer_map in racer_maps)
+        num_dirs = len(self.dir_layer)
+        self.heading_reward = np.zeros((self.num_maps, num_dirs, max_codes))
+        for map_id, racer_map in enumerate(racer_maps):
+            num_codes = racer_map.heading_reward.shape[1]
+            self.heading_reward[map_id, :, :num_codes] = racer_map.heading_reward
+
+    def heading_code_batch(self, map_id, pos_x, pos_y, dir_id):
+        """the heading code of the road under each car, on its map
+
+        same as RacerMap.heading_code_batch, the codes are the ones of the
+        map of each car
+        """
+        layer_wid = self.layer_wid[map_id]
+        layer_hei = self.layer_hei[map_id]
+        layer_x = pos_x - self.heading_origin[map_id, 0]
+        layer_y = pos_y - self.heading_origin[map_id, 1]
+        inside = (layer_x >= 0) & (layer_x < layer_wid)
+        inside &= (layer_y >= 0) & (layer_y < layer_hei)
+
+        # the flat index of the code in the layers of the map of each car
+        layer_id = self.dir_layer[dir_id]
+        code_id = (layer_id * layer_wid + layer_x) * layer_hei + layer_y
+        code_id += self.layer_offset[map_id]
+        code = self.heading_buffer[np.where(inside, code_id, 0)]
+        return np.where(inside, code, self.off_road_code[map_id])
@@ -0,0 +1,211 @@
+import numpy as np
+from math import cos
+from math import radians
+from math import sin
+
+from gym_racer.envs.racer_contacts import CarSpatialHash
+from gym_racer.envs.racer_contacts import car_contacts
+from gym_racer.envs.racer_vector_env import VectorRacerEnv
+
+
+class MultiRacerEnv(VectorRacerEnv):
+    """Many racer cars driving on the same road, in the same episode
+
+    The cars share the RacerMap, the road maps and the sensor tables, and
+    are stepped together with the vectorized code of VectorRacerEnv: obs,
+    rewards and dones are stacked arrays with one row for each agent.
+
+    Unlike VectorRacerEnv the cars are not reset when they leave the road:
+    a car that is done stops where it is and gets reward 0, until all the
+    cars are done and the env is reset.
+
+    With collide_cars the cars that are still racing crash when their rects
+    touch: they are done and get contact_reward. The contacts are found with
+    a CarSpatialHash, and the cars start in separate slots on the road.
+    """
+
+    def __init__(
+        self,
+        num_agents=2,
+        sensor_array_type="lidar",
+        sensor_array_params=None,
+        dir_step=3,
+        speed_step=1,
+        disk_cache=False,
+        cache_dir=None,
+        track=None,
+        collide_cars=False,
+        contact_reward=0,
+    ):
+        """
+        num_agents: the number of cars on the road
+        collide_cars: end the episode of the cars that touch each other
+        contact_reward: the reward of a car that touches another one
+        the other params are the same of VectorRacerEnv
+        """
+        self.num_agents = num_agents
+        self.collide_cars = collide_cars
+        self.contact_reward = contact_reward
+        super().__init__(
+            num_cars=num_agents,
+            sensor_array_type=sensor_array_type,
+            sensor_array_params=sensor_array_params,
+            dir_step=dir_step,
+            speed_step=speed_step,
+            disk_cache=disk_cache,
+            cache_dir=cache_dir,
+            track=track,
+        )
+
+    def step(self, actions):
+        """Perform one action for each car
+
+        actions has shape (num_agents, 2), each row is an action of racer-v0,
+        the actions of the cars that are done are ignored
+
+        returns stacked obs, rewards, dones and a dict of car state arrays,
+        info["all_done"] is True when all the cars are done
+        """
+        actions = np.asarray(actions)
+
+        # the cars that are done do not move
+        actions = np.where(self.dones[:, None], 0, actions)
+
+        # update the cars
+        self._step_cars(actions)
+
+        # compute the reward for this action
+        rewards, new_dones = self._compute_reward()
+        rewards[self.dones] = 0
+
+        # the cars still on the road crash if they touch
+        contacts = np.zeros(self.num_agents, dtype=bool)
+        if self.collide_cars:
+            racing = ~(self.dones | new_dones)
+            contacts[racing] = self._car_contacts(racing)
+            rewards[contacts] = self.contact_reward
+            new_dones |= contacts
+
+        self.dones |= new_dones
+        self.speed[self.dones] = 0
+
+        # create recap of the cars state
+        info = {
+            "car_pos_x": self.pos_x.copy(),
+            "car_pos_y": self.pos_y.copy(),
+            "car_dir": self.direction.copy(),
+            "car_speed": self.speed.copy(),
+            "car_contact": contacts,
+            "all_done": bool(self.dones.all()),
+        }
+
+        # get collisions from sensor array and analyze them
+        self._collide_sensor_array()
+        obs = self._analyze_collisions()
+
+        return obs, rewards, self.dones.copy(), info
+
+    def _setup_tables(self):
+        """stack the tables of the template car, and the rects for the contacts
+        """
+        super()._setup_tables()
+
+        # the size of the car rect, indexed by direction // dir_step
+        all_dirs = range(0, 360, self.dir_step)
+        rot_car_rect = self.template_car.rot_car_rect
+        self.rect_wid = np.array([rot_car_rect[dire].width for dire in all_dirs])
+        self.rect_hei = np.array([rot_car_rect[dire].height for dire in all_dirs])
+
+        if self.collide_cars:
+            # two cars can touch only if in the same or in near cells
+            cell_size = int(max(self.rect_wid.max(), self.rect_hei.max()))
+            self.spatial_hash = CarSpatialHash(cell_size)
+            self._setup_start_slots(cell_size + 1)
+
+    def _setup_start_slots(self, slot_step):
+        """the places where the cars can start without touching each other
+
+        a grid of slots along each segment, slot_step apart, without the
+        slots that touch a previous one where the segments overlap
+        """
+        segment_hei = self.racer_map.segment_hei
+
+        slots = []
+        seg_lengths = zip(self.racer_map.seg_info, self.racer_map.seg_length)
+        for (direction, cx, cy), length in seg_lengths:
+            # the vector along the direction, like RacerCar.step, the y axis
+            # points down
+            vec_x = cos(radians(360 - direction))
+            vec_y = sin(radians(360 - direction))
+            num_along = length // slot_step
+            num_across = segment_hei // slot_step
+            for i in range(num_along):
+                along = (2 * i - num_along + 1) * slot_step // 2
+                for j in range(num_across):
+                    across = (2 * j - num_across + 1) * slot_step // 2
+                    slot_x = round(cx + along * vec_x - across * vec_y)
+                    slot_y = round(cy + along * vec_y + across * vec_x)
+                    slots.append((direction, slot_x, slot_y))
+        slots = np.array(slots, dtype=np.int64).reshape(-1, 3)
+
+        # drop the later slot of each pair that touches, the rects are the
+        # largest ones so the cars fit in any direction
+        slot_hash = CarSpatialHash(slot_step)
+        first, second = slot_hash.candidate_pairs(slots[:, 1], slots[:, 2])
+        touching = (np.abs(slots[first, 1] - slots[second, 1]) < slot_step) & (
+            np.abs(slots[first, 2] - slots[second, 2]) < slot_step
+        )
+        dropped = np.maximum(first, second)[touching]
+        self.start_slots = np.delete(slots, dropped, axis=0)
+
+        if self.num_agents > len(self.start_slots):
+            info_str = f"There are {self.num_agents} cars"
+            info_str += f", but the road has room for {len(self.start_slots)}"
+            raise ValueError(info_str)
+
+    def _reset_cars(self, which):
+        """place the selected cars on the road
+
+        with collide_cars each car starts in a different slot
+        """
+        if not self.collide_cars:
+            super()._reset_cars(which)
+            return
+
+        num_reset = np.count_nonzero(which)
+        slot_id = np.random.choice(len(self.start_slots), num_reset, replace=False)
+        direction, pos_x, pos_y = self.start_slots[slot_id].T
+
+        self.pos_x[which] = pos_x
+        self.pos_y[which] = pos_y
+        self.precise_x[which] = pos_x
+        self.precise_y[which] = pos_y
+        self.direction[which] = direction
+        self.speed[which] = 0
+
+    def _car_contacts(self, which):
+        """find the selected cars that touch another selected car
+        """
+        dir_id = self.direction[which] // self.dir_step
+        return car_contacts(
+            self.spatial_hash,
+            self.pos_x[which],
+            self.pos_y[which],
+            self.rect_wid[dir_id],
+            self.rect_hei[dir_id],
+        )
+
+    def render(self, mode="console", close=False, reward=None):
+        """Print the state of the cars
+        """
+        if mode != "console":
+            raise ValueError(f"Unknown render mode {mode}")
+
+        for agent in range(self.num_agents):
+            info_str = f"Car {agent}:"
+            info_str += f" speed: {self.speed[agent]}"
+            info_str += f" dir: {self.direction[agent]}"
+            info_str += f" done: {self.dones[agent]}"
+            if reward is not None:
+                info_str += f"\tReward: {reward[agent]}"
+            print(info_str)
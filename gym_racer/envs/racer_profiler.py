@@ -0,0 +1,84 @@
+import numpy as np
+from time import perf_counter_ns
+
+
+class PhaseProfiler:
+    """Count and time the phases of the env, with a histogram for each one
+
+    The histograms have power of two bins in nanoseconds: a time t goes in
+    the bin t.bit_length(), so bin b holds the times in [2**(b-1), 2**b) ns.
+    Recording a time is a few integer operations, no array is allocated.
+    """
+
+    num_bins = 40
+
+    def __init__(self, phases):
+        """
+        phases: the names of the phases to time
+        """
+        self.phases = list(phases)
+        self.clock = perf_counter_ns
+
+        self.counts = {}
+        self.totals = {}
+        self.mins = {}
+        self.maxs = {}
+        self.hists = {}
+        self.last = {}
+        self.reset()
+
+    def reset(self):
+        """forget all the recorded times
+        """
+        for phase in self.phases:
+            self.counts[phase] = 0
+            self.totals[phase] = 0
+            self.mins[phase] = 0
+            self.maxs[phase] = 0
+            self.hists[phase] = [0] * self.num_bins
+            self.last[phase] = 0
+
+    def record(self, phase, elapsed):
+        """add a time in nanoseconds to the phase
+        """
+        count = self.counts[phase]
+        if count == 0 or elapsed < self.mins[phase]:
+            self.mins[phase] = elapsed
+        if elapsed > self.maxs[phase]:
+            self.maxs[phase] = elapsed
+        self.counts[phase] = count + 1
+        self.totals[phase] += elapsed
+        self.last[phase] = elapsed
+
+        b = elapsed.bit_length()
+        if b >= self.num_bins:
+            b = self.num_bins - 1
+        self.hists[phase][b] += 1
+
+    def summary(self):
+        """the stats of each phase, times in seconds
+
+        returns a dict phase: dict with count, total, mean, min, max, hist
+        and bin_edges, where hist[i] counts the times in
+        [bin_edges[i], bin_edges[i+1])
+        """
+        bin_edges = [0.0] + [2 ** b * 1e-9 for b in range(self.num_bins)]
+        stats = {}
+        for phase in self.phases:
+            count = self.counts[phase]
+            total = self.totals[phase] * 1e-9
+            stats[phase] = {
+                "count": count,
+                "total": total,
+                "mean": total / count if count > 0 else 0.0,
+                "min": self.mins[phase] * 1e-9,
+                "max": self.maxs[phase] * 1e-9,
+                "hist": np.array(self.hists[phase]),
+                "bin_edges": np.array(bin_edges),
+            }
+        return stats
+
+    def last_times(self):
+        """the last time recorded for each phase, in seconds
+        """
+        return {phase: self.last[phase] * 1e-9 for phase in self.phases}
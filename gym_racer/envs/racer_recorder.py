@@ -0,0 +1,284 @@
+import json
+import queue
+import struct
+import threading
+import numpy as np
+
+import gym
+
+from gym_racer.envs.racer_track import default_track
+
+# the first bytes of a trajectory file, followed by the length of the json
+# header as a little endian uint32, the header and then the records
+TRAJECTORY_MAGIC = b"RACERTRJ"
+
+# one record for each reset and step, the reset has step 0
+RECORD_DTYPE = np.dtype(
+    [
+        ("episode", "<u4"),
+        ("step", "<u4"),
+        ("action", "u1", (2,)),
+        ("pos_x", "<i4"),
+        ("pos_y", "<i4"),
+        ("direction", "<i2"),
+        ("speed", "<f4"),
+        ("reward", "<f4"),
+        ("done", "u1"),
+        ("flip_segments", "u1"),
+        ("track_id", "<u2"),
+    ]
+)
+
+# the same layout of RECORD_DTYPE, to pack a record without numpy
+RECORD_STRUCT = struct.Struct("<IIBBiihffBBH")
+
+
+class TrajectoryRecorder(gym.Wrapper):
+    """Stream the trajectories of a RacerEnv to a binary file
+
+    For each reset and step a fixed width record (see RECORD_DTYPE) is saved
+    with the action, the pose of the car after it, the reward and done; the
+    reset records also have the map in use. The records are collected in
+    chunks of chunk_size, that a background thread writes to the file, so
+    the step only copies a few numbers.
+
+    Close the recorder to write the last chunk. Load the records with
+    load_trajectory, and simulate them again with replay_trajectory.
+
+    If the writer fails (disk full, closed file) its exception is raised by
+    the next reset, step or close.
+    """
+
+    def __init__(self, env, path, chunk_size=4096):
+        super().__init__(env)
+        self.path = path
+        self.chunk_size = chunk_size
+
+        self.episode = -1
+        self.step_id = 0
+
+        racer_env = env.unwrapped
+        self.racer_env = racer_env
+        self.racer_car = racer_env.racer_car
+        header = {
+            "record_dtype": RECORD_DTYPE.descr,
+            "dir_step": racer_env.dir_step,
+            "speed_step": racer_env.speed_step,
+            "track_keys": _track_keys(racer_env),
+        }
+        header_bytes = json.dumps(header).encode()
+
+        self.file = open(path, "wb")
+        self.file.write(TRAJECTORY_MAGIC)
+        self.file.write(np.uint32(len(header_bytes)).tobytes())
+        self.file.write(header_bytes)
+
+        self.record_size = RECORD_STRUCT.size
+        self.chunk = bytearray(chunk_size * self.record_size)
+        self.num_records = 0
+
+        # the writer thread saves the full chunks in order, an exception in
+        # the thread is kept and raised in the main thread
+        self.write_error = None
+        self.write_error_raised = False
+        self.chunk_queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write_chunks, daemon=True)
+        self.writer.start()
+
+    def reset(self, **kwargs):
+        self._check_writer()
+        obs = self.env.reset(**kwargs)
+
+        self.episode += 1
+        self.step_id = 0
+        self._record((0, 0), 0.0, False)
+
+        return obs
+
+    def step(self, action):
+        self._check_writer()
+        obs, reward, done, info = self.env.step(action)
+
+        self.step_id += 1
+        self._record(action, reward, done)
+
+        return obs, reward, done, info
+
+    def close(self):
+        """write the last records and close the file, then the env
+
+        the exception of the writer is raised, if it was not already
+        """
+        if self.file is not None:
+            self._flush()
+            self.chunk_queue.put(None)
+            self.writer.join()
+            self.file.close()
+            self.file = None
+        self.env.close()
+        if not self.write_error_raised:
+            self._check_writer()
+
+    def _check_writer(self):
+        """raise the exception of the writer thread, if it failed
+        """
+        if self.write_error is not None:
+            self.write_error_raised = True
+            raise self.write_error
+
+    def _record(self, action, reward, done):
+        """add a record of the current state to the chunk
+        """
+        racer_env = self.racer_env
+        racer_car = self.racer_car
+        RECORD_STRUCT.pack_into(
+            self.chunk,
+            self.num_records * self.record_size,
+            self.episode,
+            self.step_id,
+            action[0],
+            action[1],
+            racer_car.pos_x,
+            racer_car.pos_y,
+            racer_car.direction,
+            racer_car.speed,
+            reward,
+            done,
+            racer_env.racer_map.flip_segments,
+            racer_env.track_id,
+        )
+        self.num_records += 1
+        if self.num_records == self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        """send the records in the chunk to the writer, and start a new one
+        """
+        if self.num_records > 0:
+            num_bytes = self.num_records * self.record_size
+            self.chunk_queue.put(bytes(self.chunk[:num_bytes]))
+            self.num_records = 0
+
+    def _write_chunks(self):
+        """write the chunks in the queue, until None is received
+
+        after an error the chunks are dropped, and the error is kept in
+        write_error
+        """
+        while True:
+            chunk = self.chunk_queue.get()
+            if chunk is None:
+                break
+            if self.write_error is not None:
+                continue
+            try:
+                self.file.write(chunk)
+            except Exception as error:
+                self.write_error = error
+
+
+def load_trajectory(path):
+    """open a file saved by TrajectoryRecorder
+
+    returns the header dict and the records, as a read only memmap
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(TRAJECTORY_MAGIC))
+        if magic != TRAJECTORY_MAGIC:
+            raise ValueError(f"The file {path} is not a racer trajectory")
+        header_len = int(np.frombuffer(f.read(4), dtype="<u4")[0])
+        header = json.loads(f.read(header_len).decode())
+
+    offset = len(TRAJECTORY_MAGIC) + 4 + header_len
+    records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=offset)
+    return header, records
+
+
+def replay_trajectory(path, racer_env):
+    """simulate again the trajectories saved in the file
+
+    Only the car physics and the reward are computed, the sensors are not
+    collided with the road, so this is much faster than stepping the env.
+    racer_env is used for its car and maps: it must have the same dir_step,
+    speed_step and tracks of the recorded env, the render_mode and the
+    sensors do not matter, 'console' is the fastest.
+
+    returns a dict with the arrays, one value for each record:
+        * reward: the reward of the replayed step, 0 for the resets
+        * done: the done of the replayed step
+        * match: if the pose, reward and done are the same of the record
+    """
+    header, records = load_trajectory(path)
+
+    if header["dir_step"] != racer_env.dir_step:
+        info_str = f"The trajectory has dir_step {header['dir_step']}"
+        info_str += f", but the env has {racer_env.dir_step}"
+        raise ValueError(info_str)
+    if header["speed_step"] != racer_env.speed_step:
+        info_str = f"The trajectory has speed_step {header['speed_step']}"
+        info_str += f", but the env has {racer_env.speed_step}"
+        raise ValueError(info_str)
+    if header["track_keys"] != _track_keys(racer_env):
+        raise ValueError(f"The trajectory was recorded on different tracks")
+
+    if not racer_env.precomputed:
+        racer_env._setup_precomputed()
+    racer_car = racer_env.racer_car
+
+    num_records = len(records)
+    rewards = np.zeros(num_records, dtype=np.float64)
+    dones = np.zeros(num_records, dtype=bool)
+    match = np.zeros(num_records, dtype=bool)
+    speeds = np.zeros(num_records, dtype=np.float64)
+
+    # plain python values are faster to use one at a time
+    actions = records["action"].tolist()
+    steps = records["step"].tolist()
+    poses = np.stack(
+        [
+            records["pos_x"],
+            records["pos_y"],
+            records["direction"],
+        ],
+        axis=1,
+    ).tolist()
+    maps = np.stack([records["track_id"], records["flip_segments"]], axis=1).tolist()
+
+    for i in range(num_records):
+        pos_x, pos_y, direction = poses[i]
+
+        if steps[i] == 0:
+            track_id, flip_segments = maps[i]
+            racer_env._set_map(track_id, flip_segments)
+            racer_car.reset(pos_x, pos_y, direction)
+            match[i] = True
+            continue
+
+        racer_car.step(actions[i])
+        reward, done = racer_env._compute_reward()
+        rewards[i] = reward
+        dones[i] = done
+        speeds[i] = racer_car.speed
+
+        match[i] = (
+            racer_car.pos_x == pos_x
+            and racer_car.pos_y == pos_y
+            and racer_car.direction == direction
+        )
+
+    # the speeds and rewards are saved as float32
+    match &= speeds.astype(np.float32) == records["speed"]
+    match &= rewards.astype(np.float32) == records["reward"]
+    match &= dones == records["done"].astype(bool)
+
+    return {"reward": rewards, "done": dones, "match": match}
+
+
+def _track_keys(racer_env):
+    """the keys of the tracks of the env, to check that a replay is valid
+    """
+    if racer_env.track_pool is not None:
+        return [track.key() for track in racer_env.track_pool]
+    if racer_env.track is not None:
+        return [racer_env.track.key()]
+    return [default_track().key()]
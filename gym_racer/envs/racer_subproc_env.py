@@ -0,0 +1,255 @@
+import multiprocessing as mp
+import traceback
+import numpy as np
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+
+class SubprocRacerEnv:
+    """Many RacerEnv stepped in parallel in worker processes
+
+    The obs, rewards, dones and car state of all the envs are written by the
+    workers directly in shared memory buffers, so only the actions and a
+    short ack go through the pipes. The shapes of the buffers come from the
+    observation_space of the envs.
+
+    An env that is done is reset by its worker, so the obs returned for it is
+    the first one of the new episode, while the info has the car state at the
+    end of the old one.
+
+    An exception in a worker is sent back with its traceback, and raised in
+    this process as a RuntimeError.
+    """
+
+    info_keys = ["car_pos_x", "car_pos_y", "car_dir", "car_speed"]
+
+    def __init__(self, num_envs=4, env_kwargs=None, context=None):
+        """
+        env_kwargs: the arguments used to create each RacerEnv
+        context: the multiprocessing start method, None for the default one
+        """
+        self.num_envs = num_envs
+        # the workers never render to screen, the dict of the caller is kept
+        env_kwargs = dict(env_kwargs or {})
+        env_kwargs.setdefault("render_mode", "console")
+
+        ctx = mp.get_context(context)
+
+        # the workers must share the resource tracker of this process,
+        # otherwise each one would unlink the shared memory when it exits
+        resource_tracker.ensure_running()
+
+        self.remotes = []
+        self.workers = []
+        for env_id in range(self.num_envs):
+            remote, worker_remote = ctx.Pipe()
+            worker_args = (env_id, worker_remote, env_kwargs)
+            worker = ctx.Process(target=_worker, args=worker_args, daemon=True)
+            worker.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.workers.append(worker)
+
+        # the spaces of the envs define the shape of the shared buffers
+        try:
+            spaces = self._recv_all()
+        except RuntimeError:
+            for worker in self.workers:
+                worker.terminate()
+            raise
+        self.single_observation_space, self.single_action_space = spaces[0]
+        obs_space = self.single_observation_space
+
+        self.shm_blocks = []
+        self.buffers_info = []
+        obs_shape = (self.num_envs,) + obs_space.shape
+        self.obs_buf = self._create_buffer(obs_shape, obs_space.dtype)
+        self.reward_buf = self._create_buffer((self.num_envs,), np.float64)
+        self.done_buf = self._create_buffer((self.num_envs,), np.bool_)
+        info_shape = (self.num_envs, len(self.info_keys))
+        self.info_buf = self._create_buffer(info_shape, np.float64)
+
+        # tell the workers where to write
+        for remote in self.remotes:
+            remote.send(("attach", self.buffers_info))
+        self._recv_all()
+
+        self.waiting = False
+        self.closed = False
+
+    def reset(self):
+        """Reset all the envs, returns the stacked obs
+        """
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        self._recv_all()
+        return self.obs_buf.copy()
+
+    def step_async(self, actions):
+        """Send one action to each env, without waiting for the results
+        """
+        for remote, action in zip(self.remotes, actions):
+            remote.send(("step", action))
+        self.waiting = True
+
+    def step_wait(self):
+        """Wait for the envs to step, returns obs, rewards, dones and info
+
+        info is a dict of arrays with the car state of each env
+        """
+        self.waiting = False
+        self._recv_all()
+
+        info = {}
+        for i, key in enumerate(self.info_keys):
+            info[key] = self.info_buf[:, i].copy()
+        obs = self.obs_buf.copy()
+        return obs, self.reward_buf.copy(), self.done_buf.copy(), info
+
+    def step(self, actions):
+        """Perform one action for each env
+        """
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        """Stop the workers and free the shared memory
+        """
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.waiting:
+            for remote in self.remotes:
+                try:
+                    remote.recv()
+                except EOFError:
+                    pass
+        for remote in self.remotes:
+            try:
+                remote.send(("close", None))
+            except (BrokenPipeError, EOFError):
+                pass
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        for remote in self.remotes:
+            remote.close()
+
+        # drop the views before releasing the memory
+        del self.obs_buf, self.reward_buf, self.done_buf, self.info_buf
+        for shm in self.shm_blocks:
+            shm.close()
+            shm.unlink()
+
+    def __del__(self):
+        if not getattr(self, "closed", True):
+            self.close()
+
+    def _recv_all(self):
+        """receive the reply of every worker, raising the first error sent
+
+        all the replies are read before raising, so that none is left in the
+        pipes to be read as the reply of a later command
+        """
+        replies = []
+        errors = []
+        for env_id, remote in enumerate(self.remotes):
+            try:
+                status, data = remote.recv()
+            except EOFError:
+                status, data = "error", f"The worker of env {env_id} stopped\n"
+            if status == "error":
+                errors.append(data)
+            replies.append(data)
+        if len(errors) > 0:
+            raise RuntimeError(f"A RacerEnv worker failed:\n{errors[0]}")
+        return replies
+
+    def _create_buffer(self, shape, dtype):
+        """create a numpy array in a new shared memory block
+        """
+        nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.shm_blocks.append(shm)
+        self.buffers_info.append((shm.name, shape, np.dtype(dtype).str))
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _worker(env_id, remote, env_kwargs):
+    """run a RacerEnv, writing its results in its slot of the shared buffers
+
+    every reply is a tuple (status, data), an exception is sent to the
+    parent as ("error", traceback) and stops the worker
+    """
+    shm_blocks = []
+    try:
+        _run_env(env_id, remote, env_kwargs, shm_blocks)
+
+    except (KeyboardInterrupt, EOFError):
+        pass
+
+    except Exception:
+        try:
+            remote.send(("error", traceback.format_exc()))
+        except (BrokenPipeError, EOFError):
+            pass
+
+    finally:
+        for shm in shm_blocks:
+            shm.close()
+        remote.close()
+
+
+def _run_env(env_id, remote, env_kwargs, shm_blocks):
+    """the loop of _worker, the shared memory blocks are added to shm_blocks
+
+    the views of the buffers are local, so they are released before the
+    blocks are closed
+    """
+    from gym_racer.envs.racer_env import RacerEnv
+
+    env = RacerEnv(**env_kwargs)
+    remote.send(("ok", (env.observation_space, env.action_space)))
+
+    # attach to the shared buffers
+    _, buffers_info = remote.recv()
+    buffers = []
+    for name, shape, dtype in buffers_info:
+        shm = shared_memory.SharedMemory(name=name)
+        shm_blocks.append(shm)
+        buffers.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    obs_buf, reward_buf, done_buf, info_buf = buffers
+    remote.send(("ok", None))
+
+    # the slot of this env, with the shape of the obs returned by the env
+    obs_slot = obs_buf[env_id].reshape(env.obs_shape)
+
+    def write_obs(obs):
+        obs_slot[:] = obs
+
+    while True:
+        cmd, data = remote.recv()
+
+        if cmd == "step":
+            # the obs is written straight in the shared buffer
+            reward, done, info = env.step_into(data, obs_slot)
+            reward_buf[env_id] = reward
+            done_buf[env_id] = done
+            for i, key in enumerate(SubprocRacerEnv.info_keys):
+                info_buf[env_id, i] = info[key]
+            # start a new episode right away
+            if done:
+                write_obs(env.reset())
+            remote.send(("ok", None))
+
+        elif cmd == "reset":
+            write_obs(env.reset())
+            remote.send(("ok", None))
+
+        elif cmd == "close":
+            break
+
+        else:
+            raise ValueError(f"Unknown command {cmd}")
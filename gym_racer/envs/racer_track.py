@@ -0,0 +1,326 @@
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import numpy as np
+
+from gym_racer.envs.racer_cache import cached_tables
+
+
+class Track:
+    """The layout of a road: the field size and the segments
+
+    Each segment is [direction, centerx, centery], and optionally a fourth
+    value with its length, that defaults to the width of segment_size.
+    The segments define where the car starts and the direction of the road
+    used for the reward.
+
+    The road is painted from the segment rects, unless an occupancy map is
+    given: then the road is where the occupancy is not 0, and the segments
+    must cover it, as a car that touches no segment is off the road.
+    """
+
+    def __init__(
+        self, segments, field_size=(900, 900), segment_size=(350, 150), occupancy=None
+    ):
+        """
+        occupancy: array with shape field_size, indexed [x, y]
+        """
+        self.field_size = tuple(field_size)
+        self.segment_size = tuple(segment_size)
+
+        self.seg_info = []
+        self.seg_length = []
+        for segment in segments:
+            self.seg_info.append(list(segment[:3]))
+            if len(segment) > 3:
+                self.seg_length.append(segment[3])
+            else:
+                self.seg_length.append(self.segment_size[0])
+
+        self.occupancy = occupancy
+        if occupancy is not None and occupancy.shape != self.field_size:
+            info_str = f"The occupancy map has shape {occupancy.shape}"
+            info_str += f", but the field has size {self.field_size}"
+            raise ValueError(info_str)
+
+    def key(self):
+        """the hash of the content of the track, to cache the compiled maps
+        """
+        layout = {
+            "field_size": self.field_size,
+            "segment_size": self.segment_size,
+            "seg_info": self.seg_info,
+            "seg_length": self.seg_length,
+        }
+        hasher = hashlib.sha1()
+        hasher.update(json.dumps(layout, sort_keys=True).encode())
+        if self.occupancy is not None:
+            hasher.update(np.ascontiguousarray(self.occupancy, dtype=bool).tobytes())
+        return hasher.hexdigest()
+
+
+def default_track():
+    """the track of the original map, a ring of eight segments
+    """
+    # direction, centerx, centery
+    segments = [
+        [0, 200, 100],
+        [270, 450, 200],
+        [0, 550, 450],
+        [270, 800, 550],
+        [180, 700, 800],
+        [180, 350, 800],
+        [90, 100, 700],
+        [90, 100, 350],
+    ]
+    return Track(segments)
+
+
+def load_track(track_path):
+    """load a Track from a json file
+
+    the file has the keys:
+        * segments: list of [direction, centerx, centery(, length)]
+        * field_size: [wid, hei], default [900, 900]
+        * segment_size: [wid, hei], default [350, 150]
+        * occupancy: optional path, relative to the json, of an image or of a
+          .npy array with the road, see load_occupancy
+    """
+    with open(track_path) as f:
+        track_info = json.load(f)
+
+    field_size = track_info.get("field_size", (900, 900))
+    segment_size = track_info.get("segment_size", (350, 150))
+
+    occupancy = None
+    if "occupancy" in track_info:
+        track_dir = os.path.dirname(os.path.abspath(track_path))
+        occupancy_path = os.path.join(track_dir, track_info["occupancy"])
+        occupancy = load_occupancy(occupancy_path)
+
+    return Track(track_info["segments"], field_size, segment_size, occupancy)
+
+
+def load_occupancy(occupancy_path):
+    """load an occupancy map, with True where there is road
+
+    a .npy file is an array indexed [x, y], every other file is loaded as an
+    image with pygame, the road is where the pixels are not black
+    """
+    if occupancy_path.endswith(".npy"):
+        return np.load(occupancy_path) != 0
+
+    # pygame can load images without a display
+    import pygame
+
+    occupancy_surf = pygame.image.load(occupancy_path)
+    # array3d is indexed [x, y, channel], like raw_map
+    pixels = pygame.surfarray.array3d(occupancy_surf)
+    return pixels.any(axis=2)
+
+
+def generate_track(seed, field_size=(900, 900), road_wid=80, grid_step=130):
+    """generate a random track, a loop of segments along a rectilinear polygon
+
+    The polygon is the border of a random blob of cells, on a grid with
+    grid_step spacing: the blob is grown one cell at a time, keeping it
+    simply connected and without cells touching only by a corner, so the
+    border is a simple loop. Each straight run of the border becomes a
+    segment, that covers the corner where it starts.
+
+    grid_step must be larger than road_wid, so that parallel parts of the
+    road do not touch; both should be even, to keep the centers integer.
+    The same seed and params always give the same track.
+    """
+    rng = np.random.default_rng(seed)
+
+    # the grid points where the corners of the road can be
+    margin = road_wid // 2 + 10
+    num_x = (field_size[0] - 2 * margin) // grid_step
+    num_y = (field_size[1] - 2 * margin) // grid_step
+    if num_x < 1 or num_y < 1:
+        raise ValueError(f"The field {field_size} is too small for the grid")
+
+    blob = _grow_blob(rng, num_x, num_y)
+    loop = _trace_border(blob)
+
+    # drive in a random direction along the loop
+    if rng.integers(2):
+        loop = loop[::-1]
+
+    # the vectors of the directions, the y axis points down
+    dir_vec = {0: (1, 0), 90: (0, -1), 180: (-1, 0), 270: (0, 1)}
+    half_wid = road_wid // 2
+
+    segments = []
+    for start, end in zip(loop, loop[1:] + loop[:1]):
+        start_x = margin + start[0] * grid_step
+        start_y = margin + start[1] * grid_step
+        end_x = margin + end[0] * grid_step
+        end_y = margin + end[1] * grid_step
+
+        delta_x = end_x - start_x
+        delta_y = end_y - start_y
+        if delta_x > 0:
+            direction = 0
+        elif delta_x < 0:
+            direction = 180
+        elif delta_y > 0:
+            direction = 270
+        else:
+            direction = 90
+
+        # the segment goes from the start corner to the end one, excluded
+        length = abs(delta_x) + abs(delta_y)
+        vec_x, vec_y = dir_vec[direction]
+        cx = (start_x + end_x) // 2 - vec_x * half_wid
+        cy = (start_y + end_y) // 2 - vec_y * half_wid
+        segments.append([direction, cx, cy, length])
+
+    return Track(segments, field_size, (grid_step, road_wid))
+
+
+def generate_tracks(
+    seeds,
+    field_size=(900, 900),
+    road_wid=80,
+    grid_step=130,
+    processes=None,
+    cache_dir=None,
+    dir_step=3,
+):
+    """generate a track for each seed, in a process pool, caching them
+
+    The workers generate the tracks, and compile their road maps and heading
+    layers (for a car with that dir_step) in the cache dir, see get_cache_dir;
+    the tracks are cached by seed and params, so a later call with the same
+    seeds only reads them. Create the envs with disk_cache=True to open the
+    compiled maps instead of building them again.
+
+    The heading layers take about 25 MB per track with dir_step 3, use
+    dir_step None to skip them, they are then built when a track is first
+    used in an env.
+
+    returns the list of Track
+    """
+    params = (tuple(field_size), road_wid, grid_step)
+    jobs = [(seed, params, cache_dir, dir_step) for seed in seeds]
+    with mp.Pool(processes) as pool:
+        pool.map(_compile_seed_track, jobs, chunksize=max(1, len(jobs) // 64))
+
+    return [_seed_track(seed, params, cache_dir) for seed in seeds]
+
+
+def _seed_track(seed, params, cache_dir):
+    """the track generated with that seed and params, cached on disk
+    """
+    field_size, road_wid, grid_step = params
+
+    def build_track_tables():
+        track = generate_track(seed, field_size, road_wid, grid_step)
+        seg_lengths = zip(track.seg_info, track.seg_length)
+        segments = [info + [length] for info, length in seg_lengths]
+        return {"segments": np.array(segments, dtype=np.int64)}
+
+    key = f"{seed} {field_size} {road_wid} {grid_step}"
+    tables = cached_tables("track_seed", key, build_track_tables, True, cache_dir)
+    return Track(tables["segments"].tolist(), field_size, (grid_step, road_wid))
+
+
+def _compile_seed_track(job):
+    """generate a track and compile its maps in the cache dir
+    """
+    from gym_racer.envs.racer_car import RacerCar
+    from gym_racer.envs.racer_map import RacerMap
+
+    seed, params, cache_dir, dir_step = job
+    track = _seed_track(seed, params, cache_dir)
+    field_wid, field_hei = track.field_size
+    racer_map = RacerMap(
+        field_wid, field_hei, "console", track, disk_cache=True, cache_dir=cache_dir
+    )
+    if dir_step is not None:
+        racer_car = RacerCar(
+            dir_step=dir_step,
+            render_mode="console",
+            disk_cache=True,
+            cache_dir=cache_dir,
+        )
+        racer_map.precompute_heading(racer_car.rot_car_rect, True, cache_dir)
+
+
+def _grow_blob(rng, num_x, num_y):
+    """grow a random simply connected set of cells in a num_x x num_y grid
+
+    returns the set of (i, j) cells
+    """
+    num_cells = num_x * num_y
+    target = rng.integers(max(1, num_cells // 3), max(2, 2 * num_cells // 3 + 1))
+
+    # the 8 neighbours in cyclic order, orthogonal ones at even positions
+    ring = [(0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1)]
+
+    start = (int(rng.integers(num_x)), int(rng.integers(num_y)))
+    blob = {start}
+    while len(blob) < target:
+        # the free cells next to the blob, that keep it simply connected
+        candidates = set()
+        for i, j in blob:
+            for di, dj in ring[::2]:
+                cell = (i + di, j + dj)
+                if 0 <= cell[0] < num_x and 0 <= cell[1] < num_y:
+                    if cell not in blob:
+                        candidates.add(cell)
+
+        good = []
+        for i, j in sorted(candidates):
+            in_blob = [(i + di, j + dj) in blob for di, dj in ring]
+            # the neighbours in the blob must be a single run around the cell
+            runs = sum(in_blob[k - 1] == 0 and in_blob[k] for k in range(8))
+            if runs == 1:
+                good.append((i, j))
+
+        if len(good) == 0:
+            break
+        blob.add(good[rng.integers(len(good))])
+
+    return blob
+
+
+def _trace_border(blob):
+    """the corners of the border of the blob, in order along the loop
+
+    returns a list of grid points (x, y), where the direction changes
+    """
+    # each cell side on the border is an edge, oriented so that each point
+    # has a single edge leaving it
+    next_point = {}
+    for i, j in blob:
+        if (i, j - 1) not in blob:
+            next_point[(i, j)] = (i + 1, j)
+        if (i + 1, j) not in blob:
+            next_point[(i + 1, j)] = (i + 1, j + 1)
+        if (i, j + 1) not in blob:
+            next_point[(i + 1, j + 1)] = (i, j + 1)
+        if (i - 1, j) not in blob:
+            next_point[(i, j + 1)] = (i, j)
+
+    # walk the loop from the top left point, that is a corner
+    start = min(next_point)
+    points = [start]
+    point = next_point[start]
+    while point != start:
+        points.append(point)
+        point = next_point[point]
+
+    # keep only the corners
+    corners = []
+    for k, point in enumerate(points):
+        prev_point = points[k - 1]
+        next_one = points[(k + 1) % len(points)]
+        d_in = (point[0] - prev_point[0], point[1] - prev_point[1])
+        d_out = (next_one[0] - point[0], next_one[1] - point[1])
+        if d_in != d_out:
+            corners.append(point)
+    return corners
@@ -0,0 +1,368 @@
+import numpy as np
+from math import cos
+from math import radians
+from math import sin
+
+from gym import spaces
+
+from gym_racer.envs.racer_car import RacerCar
+from gym_racer.envs.racer_distfield import DistanceFieldLidar
+from gym_racer.envs.racer_map import RacerMap
+from gym_racer.envs.racer_map_stack import RacerMapStack
+from gym_racer.envs.racer_sensor import collide_sensor_array
+from gym_racer.envs.racer_track import load_track
+
+
+class VectorRacerEnv:
+    """A batch of racer cars stepped together
+
+    The state of the N cars is kept as numpy arrays (struct of arrays), and
+    the physics, the reward and the sensor collisions are computed for all the
+    cars at once. The cars are independent and drive on the same RacerMap.
+
+    With a track_pool each car drives on its own track: the maps are stacked
+    in a RacerMapStack and each car has a map_id, so the road under all the
+    cars is still read in a single gather.
+
+    When a car goes out of the road it is reset to a random segment, so the
+    obs returned for it is the first one of the new episode; with a pool
+    also the track is picked again.
+    """
+
+    def __init__(
+        self,
+        num_cars=8,
+        sensor_array_type="lidar",
+        sensor_array_params=None,
+        dir_step=3,
+        speed_step=1,
+        disk_cache=False,
+        cache_dir=None,
+        track=None,
+        track_pool=None,
+        sensor_engine="numpy",
+    ):
+        """
+        disk_cache: save the precomputed tables in cache_dir, see RacerEnv
+        track: a Track or the path of a track json, None for the original ring
+        track_pool: a list of tracks (or paths), each car drives on one of
+            them, picked at random when the car is reset; the tracks must
+            have the same field_size
+        sensor_engine: 'numpy' collides all the sensor arrays with one
+            gather, 'distfield' sphere traces the lidar rays of all the cars
+            in the distance field of the road, see DistanceFieldLidar; it
+            gives the same obs and does not work with a track_pool
+        """
+        self.num_cars = num_cars
+        self.dir_step = dir_step
+        self.speed_step = speed_step
+        self.sensor_array_type = sensor_array_type
+        self.sensor_array_params = sensor_array_params
+        self.sensor_engine = sensor_engine
+
+        # racing field dimensions
+        if isinstance(track, str):
+            track = load_track(track)
+        self.track_pool = None
+        if track_pool is not None:
+            self.track_pool = []
+            for pool_track in track_pool:
+                if isinstance(pool_track, str):
+                    pool_track = load_track(pool_track)
+                self.track_pool.append(pool_track)
+            track = self.track_pool[0]
+            field_sizes = set(pool_track.field_size for pool_track in self.track_pool)
+            if len(field_sizes) > 1:
+                info_str = "All the tracks in track_pool must have the same field_size"
+                raise ValueError(info_str)
+        if track is None:
+            self.field_wid = 900
+            self.field_hei = 900
+        else:
+            self.field_wid, self.field_hei = track.field_size
+
+        # a car used as template, to reuse the sensor arrays and car rects
+        self.template_car = RacerCar(
+            dir_step=self.dir_step,
+            speed_step=self.speed_step,
+            sensor_array_type=self.sensor_array_type,
+            render_mode="console",
+            sensor_array_params=self.sensor_array_params,
+            disk_cache=disk_cache,
+            cache_dir=cache_dir,
+        )
+
+        # the road shared by all the cars, or one for each track in the pool
+        map_tracks = [track] if self.track_pool is None else self.track_pool
+        self.racer_maps = []
+        for map_track in map_tracks:
+            racer_map = RacerMap(
+                self.field_wid,
+                self.field_hei,
+                render_mode="console",
+                track=map_track,
+                disk_cache=disk_cache,
+                cache_dir=cache_dir,
+            )
+            # with a pool the layers are painted directly in the map stack
+            racer_map.precompute_heading(
+                self.template_car.rot_car_rect,
+                disk_cache,
+                cache_dir,
+                lazy_layers=self.track_pool is not None,
+            )
+            self.racer_maps.append(racer_map)
+        self.racer_map = self.racer_maps[0]
+
+        # the maps stacked, indexed by the map_id of each car
+        self.map_stack = None
+        if self.track_pool is not None:
+            self.map_stack = RacerMapStack(self.racer_maps)
+
+        self._setup_tables()
+        self._setup_sensor_engine()
+
+        # Define action and observation space
+        self._setup_action_obs_space()
+
+        # the state of the cars
+        self.pos_x = np.zeros(self.num_cars, dtype=np.int64)
+        self.pos_y = np.zeros(self.num_cars, dtype=np.int64)
+        self.precise_x = np.zeros(self.num_cars, dtype=np.float64)
+        self.precise_y = np.zeros(self.num_cars, dtype=np.float64)
+        self.direction = np.zeros(self.num_cars, dtype=np.int64)
+        self.speed = np.zeros(self.num_cars, dtype=np.float64)
+        self.dones = np.zeros(self.num_cars, dtype=bool)
+        self.map_id = np.zeros(self.num_cars, dtype=np.int64)
+
+        self.reset()
+
+    def step(self, actions):
+        """Perform one action for each car
+
+        actions has shape (num_cars, 2), each row is an action of racer-v0
+
+        returns stacked obs, rewards, dones and a dict of car state arrays
+        """
+        actions = np.asarray(actions)
+
+        # update the cars
+        self._step_cars(actions)
+
+        # compute the reward for this action
+        rewards, self.dones = self._compute_reward()
+
+        # create recap of the cars state, before resetting the finished ones
+        info = {
+            "car_pos_x": self.pos_x.copy(),
+            "car_pos_y": self.pos_y.copy(),
+            "car_dir": self.direction.copy(),
+            "car_speed": self.speed.copy(),
+            "map_id": self.map_id.copy(),
+        }
+
+        # start a new episode for the cars that left the road
+        if self.dones.any():
+            self._reset_cars(self.dones)
+
+        # get collisions from sensor array and analyze them
+        self._collide_sensor_array()
+        obs = self._analyze_collisions()
+
+        return obs, rewards, self.dones.copy(), info
+
+    def reset(self):
+        """Reset all the cars to an initial state
+        """
+        self._reset_cars(np.ones(self.num_cars, dtype=bool))
+        self.dones[:] = False
+
+        self._collide_sensor_array()
+        return self._analyze_collisions()
+
+    def _setup_tables(self):
+        """stack the per direction tables of the template car in arrays
+
+        all the tables are indexed by direction // dir_step
+        """
+        all_dirs = range(0, 360, self.dir_step)
+
+        # sensor arrays, shape (dir_num, m, n, 2)
+        self.all_sensor_array = np.stack(
+            [self.template_car.all_sensor_array[dire] for dire in all_dirs]
+        )
+
+        # car displacement for unit speed, same math as RacerCar.step
+        self.delta_x = np.array([cos(radians(360 - dire)) for dire in all_dirs])
+        self.delta_y = np.array([sin(radians(360 - dire)) for dire in all_dirs])
+
+        self.seg_info = np.array(self.racer_map.seg_info)
+
+    def _setup_sensor_engine(self):
+        """check the sensor_engine and build its data
+        """
+        if self.sensor_engine == "numpy":
+            pass
+
+        elif self.sensor_engine == "distfield":
+            if self.sensor_array_type != "lidar":
+                info_str = "The distfield sensor_engine only works with the lidar"
+                raise ValueError(info_str)
+            if self.map_stack is not None:
+                info_str = "The distfield sensor_engine works with a single track"
+                raise ValueError(info_str)
+            self.ray_lidar = DistanceFieldLidar(self.template_car, self.racer_map)
+
+        else:
+            raise ValueError(f"Unknown sensor_engine {self.sensor_engine}")
+
+    def _setup_action_obs_space(self):
+        """
+        """
+        self.single_action_space = spaces.MultiDiscrete([3, 3])
+        self.action_space = spaces.MultiDiscrete(np.full((self.num_cars, 2), 3))
+
+        if self.sensor_array_type == "diamond":
+            HEIGHT = self.template_car.viewfield_size
+            WIDTH = self.template_car.viewfield_size
+            obs_shape = (HEIGHT, WIDTH)
+
+        elif self.sensor_array_type == "lidar":
+            HEIGHT = self.template_car.tot_ray_num
+            obs_shape = (HEIGHT,)
+
+        else:
+            raise ValueError(f"Unknown sensor_array_type {self.sensor_array_type}")
+
+        self.single_observation_space = spaces.Box(
+            low=0, high=1, shape=obs_shape, dtype=np.uint8
+        )
+        self.observation_space = spaces.Box(
+            low=0, high=1, shape=(self.num_cars,) + obs_shape, dtype=np.uint8
+        )
+
+    def _step_cars(self, actions):
+        """vectorized version of RacerCar.step
+        """
+        accelerate = actions[:, 0]
+        steer = actions[:, 1]
+
+        # control the speed of the cars
+        self.speed += np.where(accelerate == 1, self.speed_step, 0)
+        down = accelerate == 2
+        self.speed[down] = np.maximum(self.speed[down] - self.speed_step, 0)
+
+        # steer the cars
+        self.direction += np.where(steer == 1, self.dir_step, 0)
+        self.direction -= np.where(steer == 2, self.dir_step, 0)
+        self.direction %= 360
+
+        # move the cars
+        dir_id = self.direction // self.dir_step
+        self.precise_x += self.delta_x[dir_id] * self.speed
+        self.precise_y += self.delta_y[dir_id] * self.speed
+        self.pos_x = self.precise_x.astype(np.int64)
+        self.pos_y = self.precise_y.astype(np.int64)
+
+    def _reset_cars(self, which):
+        """place the selected cars on a random segment of the map
+
+        with a track_pool each car is also placed on a random map
+        """
+        num_reset = np.count_nonzero(which)
+        if self.map_stack is None:
+            seg_id = np.random.randint(len(self.seg_info), size=num_reset)
+            direction, pos_x, pos_y = self.seg_info[seg_id].T
+        else:
+            map_id = np.random.randint(self.map_stack.num_maps, size=num_reset)
+            num_segments = self.map_stack.num_segments[map_id]
+            seg_id = (np.random.random(num_reset) * num_segments).astype(np.int64)
+            direction, pos_x, pos_y = self.map_stack.seg_info[map_id, seg_id].T
+            self.map_id[which] = map_id
+
+        self.pos_x[which] = pos_x
+        self.pos_y[which] = pos_y
+        self.precise_x[which] = pos_x
+        self.precise_y[which] = pos_y
+        self.direction[which] = direction
+        self.speed[which] = 0
+
+    def _compute_reward(self):
+        """compute the reward for moving on the map, for all the cars
+
+        same rules as RacerEnv._compute_reward
+        """
+        # the heading of the road under the cars, from the precomputed layers
+        dir_id = self.direction // self.dir_step
+        if self.map_stack is None:
+            heading_code = self.racer_map.heading_code_batch(
+                self.pos_x, self.pos_y, dir_id
+            )
+            # the direction error, scaled from -1 to 1
+            rewards = self.racer_map.heading_reward[dir_id, heading_code]
+            off_road_code = self.racer_map.off_road_code
+        else:
+            heading_code = self.map_stack.heading_code_batch(
+                self.map_id, self.pos_x, self.pos_y, dir_id
+            )
+            rewards = self.map_stack.heading_reward[self.map_id, dir_id, heading_code]
+            off_road_code = self.map_stack.off_road_code[self.map_id]
+
+        # make it proportional to speed squared
+        rewards = rewards * (self.speed * self.speed)
+
+        # if it is in the map, check that is moving
+        rewards[self.speed < 0.0001] = -1
+
+        # out of the map
+        dones = heading_code == off_road_code
+        rewards[dones] = 0
+
+        return rewards, dones
+
+    def _collide_sensor_array(self):
+        """get the sa for the current directions and collide them with the road
+        """
+        dir_id = self.direction // self.dir_step
+
+        # the lidar obs is traced directly, without the sensor arrays
+        if self.sensor_engine == "distfield":
+            self.lidar_obs = self.ray_lidar.lookup(self.pos_x, self.pos_y, dir_id)
+            return
+
+        car_pos = np.stack((self.pos_x, self.pos_y), axis=-1)
+        self.curr_sa = self.all_sensor_array[dir_id] + car_pos[:, None, None, :]
+
+        if self.map_stack is None:
+            self.sa_collisions = collide_sensor_array(
+                self.curr_sa, self.racer_map.raw_map, self.sensor_array_type
+            )
+        else:
+            self.sa_collisions = collide_sensor_array(
+                self.curr_sa,
+                self.map_stack.raw_maps,
+                self.sensor_array_type,
+                map_id=self.map_id,
+            )
+
+    def _analyze_collisions(self):
+        """parse the collision matrices into stacked obs
+        """
+        if self.sensor_array_type == "diamond":
+            # return the entire matrices
+            obs = self.sa_collisions
+
+        elif self.sensor_array_type == "lidar" and self.sensor_engine == "distfield":
+            obs = self.lidar_obs
+
+        elif self.sensor_array_type == "lidar":
+            # the index of the first sensor out of the road on each ray
+            pad_shape = self.sa_collisions.shape[:-1] + (1,)
+            zero_strip = np.zeros(pad_shape, dtype=np.uint8)
+            pad_collisions = np.concatenate((self.sa_collisions, zero_strip), axis=-1)
+            obs = np.argmin(pad_collisions, axis=-1).astype(np.uint8)
+
+        else:
+            raise ValueError(f"Unknown sensor_array_type {self.sensor_array_type}")
+
+        return obs
@@ -1,4 +1,5 @@
 import logging
+import os
 import numpy as np
 
 from math import cos
@@ -14,6 +15,20 @@ def getMyLogger(logger_name, log_level="DEBUG"):
     return logg
 
 
+def get_cache_dir(cache_dir=None):
+    """returns the dir where the precomputed data is saved, creating it
+
+    if cache_dir is None, the GYM_RACER_CACHE_DIR environment variable is
+    used, and then ~/.cache/gym_racer
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get("GYM_RACER_CACHE_DIR")
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "gym_racer")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
 def compute_rot_matrix(theta):
     """compute the rotation matrix for angle theta in degrees
     """
@@ -26,3 +41,86 @@ def compute_rot_matrix(theta):
     #  logg.debug(f"rot_mat = {rot_mat}")
 
     return rot_mat
+
+
+def rotated_size(wid, hei, angle):
+    """compute the size of a wid x hei surface rotated by angle in degrees
+
+    same computation done by pygame.transform.rotate, so the rotated rects
+    can be created without pygame
+    """
+    # multiples of 90 are exact rotations
+    if angle % 90 == 0:
+        if (angle // 90) % 2 == 0:
+            return wid, hei
+        return hei, wid
+
+    theta = radians(angle)
+    ct = cos(theta)
+    st = sin(theta)
+    cx, cy = ct * wid, ct * hei
+    sx, sy = st * wid, st * hei
+    new_wid = int(max(abs(cx + sy), abs(cx - sy), abs(-cx + sy), abs(-cx - sy)))
+    new_hei = int(max(abs(sx + cy), abs(sx - cy), abs(-sx + cy), abs(-sx - cy)))
+    return new_wid, new_hei
+
+
+class Rect:
+    """minimal integer rect, with the same semantics of pygame.Rect
+
+    only what the env needs to place the car and collide it with the road
+    """
+
+    __slots__ = ("left", "top", "width", "height")
+
+    def __init__(self, left, top, width, height):
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+
+    def __repr__(self):
+        return f"<Rect({self.left}, {self.top}, {self.width}, {self.height})>"
+
+    @property
+    def right(self):
+        return self.left + self.width
+
+    @property
+    def bottom(self):
+        return self.top + self.height
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    @property
+    def topleft(self):
+        return self.left, self.top
+
+    @property
+    def center(self):
+        return self.left + self.width // 2, self.top + self.height // 2
+
+    @center.setter
+    def center(self, value):
+        cx, cy = value
+        self.left = cx - self.width // 2
+        self.top = cy - self.height // 2
+
+    def copy(self):
+        return Rect(self.left, self.top, self.width, self.height)
+
+    def colliderect(self, other):
+        """True if the two rects overlap, touching edges do not count
+        """
+        if self.width == 0 or self.height == 0:
+            return False
+        if other.width == 0 or other.height == 0:
+            return False
+        return (
+            self.left < other.right
+            and other.left < self.right
+            and self.top < other.bottom
+            and other.top < self.bottom
+        )
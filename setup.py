@@ -16,10 +16,12 @@ setuptools.setup(
     url="https://github.com/Pitrified/gym-racer",
     packages=setuptools.find_packages(where="."),
     install_requires=["gym", "pygame", "numpy"],
+    # gym registers the envs when it is imported
+    entry_points={"gym.envs": ["__root__ = gym_racer:register_envs"]},
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires=">=3.6",
+    python_requires=">=3.8",
 )